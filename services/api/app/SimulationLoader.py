@@ -1,35 +1,192 @@
 # Author: Tobias Bergkvist
 # Purpose: Load/parse data/config files for a specific HeaveSIM simulation.
+# The large simulation outputs (pipepressure.csv etc.) are converted to a binary cache the first time they are read,
+# so that later loads only need to memory-map a few .npy-files instead of parsing hundreds of MB of text.
 
 import pandas as pd
 import numpy as np
+import tempfile
+import shutil
+import fcntl
+import json
+import os
 from math import pi
 
+from app.instrumentation import stage, staged
+
+simulation_names = ['pipepressure', 'annuluspressure', 'pipestress']
+cache_version = 2
+
 
 class SimulationLoader:
-    def __init__(self, data_dir: str):
+    def __init__(self, data_dir: str, cache_dir: str = None, dtype=np.float64):
         self.data_dir = data_dir
+        self.cache_dir = cache_dir if cache_dir is not None else f'{data_dir}/.cache'
+        self.dtype = np.dtype(dtype)
 
     def path(self, file_name: str):
         return f'{self.data_dir}/{file_name}'
 
+    def cache_path(self, file_name: str):
+        return f'{self.cache_dir}/{file_name}'
+
     def pipepressure(self):
-        return pd.read_csv(self.path('pipepressure.csv'), index_col=0).rename(columns=float)
+        return self.simulation_data('pipepressure')
 
     def annuluspressure(self):
-        return pd.read_csv(self.path('annuluspressure.csv'), index_col=0).rename(columns=float)
+        return self.simulation_data('annuluspressure')
 
     def pipestress(self):
-        return pd.read_csv(self.path('pipestress.csv'), index_col=0).rename(columns=float)
+        return self.simulation_data('pipestress')
+
+    def simulation_data(self, name: str) -> pd.DataFrame:
+        # Rows are time steps, columns are measure depths (as floats)
+        time, md, values, index_name = self.simulation_arrays_or_csv(name)
+        return pd.DataFrame(values, index=pd.Index(time, name=index_name), columns=pd.Index(md), copy=False)
+
+    def simulation_slice(self, name: str, t_start: float = None, t_stop: float = None, md_start: float = None, md_stop: float = None, stride: int = 1) -> pd.DataFrame:
+        # Like simulation_data, but only containing times in [t_start, t_stop] (every stride'th time step),
+        # and measure depths in [md_start, md_stop]. Only the selected block is read from the memory-mapped cache.
+        time, md, values, index_name = self.simulation_arrays_or_csv(name)
+        rows = slice(*index_range(time, t_start, t_stop), stride)
+        columns = slice(*index_range(md, md_start, md_stop))
+        return pd.DataFrame(values[rows, columns], index=pd.Index(time[rows], name=index_name), columns=pd.Index(md[columns]), copy=False)
+
+    @staged('load')
+    def simulation_arrays_or_csv(self, name: str):
+        try:
+            return self.simulation_arrays(name)
+        except OSError:
+            # The cache could not be written (read-only data volume for example), so fall back to parsing the csv.
+            data = read_simulation_csv(self.path(f'{name}.csv'))
+            return data.index.values, data.columns.values, data.values, data.index.name
+
+    @staged('load')
+    def simulation_axes(self, name: str):
+        # Returns (time, md, index_name) like simulation_arrays_or_csv, without the values. When the cache can't be written,
+        # only the header and the first column of the csv are parsed, which is a lot faster than parsing all of it.
+        try:
+            time, md, _, index_name = self.simulation_arrays(name)
+            return time, md, index_name
+        except OSError:
+            header = pd.read_csv(self.path(f'{name}.csv'), index_col=0, nrows=0)
+            time = pd.read_csv(self.path(f'{name}.csv'), usecols=[0]).iloc[:, 0].values
+            return time, header.columns.astype(float).values, header.index.name
+
+    def simulation_arrays(self, name: str):
+        # Returns (time, md, values, index_name), where the arrays are memory-mapped from the binary cache.
+        if not self.is_cache_fresh(name):
+            self.build_cache_once(name)
+        try:
+            return self.cached_arrays(name)
+        except ValueError:
+            # The cache files don't match each other (left behind by a crashed build for example), so start over
+            self.build_cache_once(name, force=True)
+            return self.cached_arrays(name)
+
+    def cached_arrays(self, name: str):
+        with open(self.cache_path(f'{name}.meta.json')) as f:
+            meta = json.load(f)
+        time = np.load(self.cache_path(f'{name}.time.npy'), mmap_mode='r')
+        md = np.load(self.cache_path(f'{name}.md.npy'), mmap_mode='r')
+        values = np.load(self.cache_path(f'{name}.values.npy'), mmap_mode='r')
+        if values.shape != (len(time), len(md)):
+            raise ValueError(f'The cached values of {name} have shape {values.shape} instead of {(len(time), len(md))}')
+        return time, md, values, meta['index_name']
+
+    def build_cache_once(self, name: str, force: bool = False):
+        # Build the cache, unless another thread or process did so while waiting for the lock
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with locked_file(self.cache_path(f'{name}.lock')):
+            if force or not self.is_cache_fresh(name):
+                self.build_cache(name)
+
+    def is_cache_fresh(self, name: str) -> bool:
+        try:
+            with open(self.cache_path(f'{name}.meta.json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return meta == self.cache_meta(name, meta.get('index_name'))
+
+    def cache_meta(self, name: str, index_name) -> dict:
+        source = os.stat(self.path(f'{name}.csv'))
+        return {
+            'version': cache_version,
+            'source_mtime_ns': source.st_mtime_ns,
+            'source_size': source.st_size,
+            'dtype': self.dtype.str,
+            'index_name': index_name,
+        }
+
+    @staged('parse')
+    def build_cache(self, name: str):
+        # Convert the csv to separate time/md/value arrays, reading it in chunks of rows so that memory use stays
+        # bounded no matter how long the simulation is (see write_array_chunks).
+        # Every file is written to a temporary name first and then renamed, so that concurrent readers never see
+        # a half-written cache. The meta file is written last, and is what marks the cache as valid.
+        source = self.path(f'{name}.csv')
+        meta = self.cache_meta(name, None)
+        header = pd.read_csv(source, index_col=0, nrows=0)
+        md = header.columns.astype(float).values
+        meta['index_name'] = header.index.name
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        time_chunks = []
+        def value_chunks():
+            for chunk in pd.read_csv(source, index_col=0, chunksize=rows_per_chunk(len(md))):
+                time_chunks.append(chunk.index.values.astype(np.float64))
+                yield chunk.values
+        write_array_chunks(self.cache_path(f'{name}.values.npy'), value_chunks(), len(md), self.dtype)
+        time = np.concatenate(time_chunks) if time_chunks else np.empty(0)
+        write_atomically(self.cache_path(f'{name}.time.npy'), lambda f: np.save(f, time))
+        write_atomically(self.cache_path(f'{name}.md.npy'), lambda f: np.save(f, md))
+        write_atomically(self.cache_path(f'{name}.meta.json'), lambda f: f.write(json.dumps(meta).encode()))
+
+    def simulation_chunks(self, name: str, t_start: float = None, t_stop: float = None, md_start: float = None, md_stop: float = None, stride: int = 1, chunk_rows: int = None):
+        # Iterate over the same block as simulation_slice, chunk_rows time steps at a time.
+        # The chunks are read from the cache with regular reads instead of through a memory map,
+        # so that the pages of the file don't stay resident in the process while going through it.
+        time, md, _ = self.simulation_axes(name)
+        row_start, row_stop = index_range(time, t_start, t_stop)
+        column_start, column_stop = index_range(md, md_start, md_stop)
+        chunk_rows = chunk_rows or rows_per_chunk(column_stop - column_start)
+        if not self.is_cache_fresh(name):
+            # The cache could not be built, so there is nothing to stream from
+            values = self.simulation_slice(name, t_start, t_stop, md_start, md_stop, stride).values
+            for start in range(0, len(values), chunk_rows):
+                yield values[start:start + chunk_rows]
+            return
+        with open(self.cache_path(f'{name}.values.npy'), 'rb') as f:
+            np.lib.format.read_magic(f)
+            shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+            offset = f.tell()
+            row_bytes = shape[1] * dtype.itemsize
+            for start in range(row_start, row_stop, chunk_rows * stride):
+                rows = range(start, min(start + chunk_rows * stride, row_stop), stride)
+                with stage('load'):
+                    if stride == 1:
+                        f.seek(offset + start * row_bytes)
+                        chunk = np.fromfile(f, dtype=dtype, count=len(rows) * shape[1]).reshape(len(rows), shape[1])
+                    else:
+                        # Read only the rows that are kept, instead of everything in between
+                        chunk = np.empty((len(rows), shape[1]), dtype=dtype)
+                        for i, row in enumerate(rows):
+                            f.seek(offset + row * row_bytes)
+                            chunk[i] = np.fromfile(f, dtype=dtype, count=shape[1])
+                yield chunk[:, column_start:column_stop]
 
+    @staged('load')
     def fluiddef(self):
         with open(self.path('fluiddef.txt')) as f:
             return parse_txt(f.readlines())
 
+    @staged('load')
     def geometrydef(self):
         with open(self.path('geometrydef.txt')) as f:
             return parse_txt(f.readlines())
 
+    @staged('load')
     def well_path(self):
         return pd.read_csv(self.path('well_path.csv'), sep=';').rename(columns={
             'Md': 'md',
@@ -40,9 +197,79 @@ class SimulationLoader:
         })[['md', 'inc', 'azi', 'tvd']]
 
 
+@staged('parse')
+def read_simulation_csv(file_path: str) -> pd.DataFrame:
+    return pd.read_csv(file_path, index_col=0).rename(columns=float)
+
+
+def rows_per_chunk(columns: int, chunk_bytes: int = 64 * 2**20) -> int:
+    # Number of rows to process at a time, so that a chunk of float64 values takes up about chunk_bytes
+    return max(1, chunk_bytes // (8 * max(1, columns)))
+
+
+def index_range(axis: np.ndarray, start: float = None, stop: float = None) -> tuple:
+    # Index range of the (sorted) axis values that are within [start, stop]. None means unbounded.
+    return (
+        0 if start is None else int(np.searchsorted(axis, start, side='left')),
+        len(axis) if stop is None else int(np.searchsorted(axis, stop, side='right')),
+    )
+
+
+def write_atomically(file_path: str, write):
+    # The temporary file has a unique name, so that concurrent writers (threads or processes) never share one
+    temporary_file, temporary_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or '.', prefix=f'{os.path.basename(file_path)}.', suffix='.tmp')
+    os.close(temporary_file)
+    try:
+        with open(temporary_path, 'wb') as f:
+            write(f)
+        # mkstemp only lets the owner read the file (and the proxy has to be able to read precomputed responses)
+        os.chmod(temporary_path, 0o644)
+        os.replace(temporary_path, file_path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+
+def write_array_chunks(file_path: str, chunks, columns: int, dtype):
+    # Write an iterable of chunks of rows (with the given number of columns) as a single .npy-file (atomically),
+    # with only one chunk in memory at a time. The number of rows is only known at the end, so the values are
+    # first written without a header, and then copied into the final .npy-file.
+    dtype = np.dtype(dtype)
+    raw_values_file, raw_values_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or '.', prefix=f'{os.path.basename(file_path)}.', suffix='.raw')
+    os.close(raw_values_file)
+    try:
+        rows = 0
+        with open(raw_values_path, 'wb') as raw_values:
+            for chunk in chunks:
+                raw_values.write(np.ascontiguousarray(chunk, dtype=dtype).tobytes())
+                rows += len(chunk)
+        npy_header = { 'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (rows, columns) }
+        def write_values(f):
+            np.lib.format.write_array_header_1_0(f, npy_header)
+            with open(raw_values_path, 'rb') as raw_values:
+                shutil.copyfileobj(raw_values, f, 2**24)
+        write_atomically(file_path, write_values)
+    finally:
+        if os.path.exists(raw_values_path):
+            os.remove(raw_values_path)
+
+
+def locked_file(file_path: str):
+    # Opens (and creates) a lock file, which stays locked until it is closed. Unlike a threading.Lock, this also
+    # works across processes (like the compute pool processes of main.py), and is released if the process dies.
+    f = open(file_path, 'w')
+    fcntl.flock(f, fcntl.LOCK_EX)
+    return f
+
+
+def visible_entries(directory: str) -> list:
+    # Hidden files (like the lock file of precompute_on_startup in main.py) are not wells or connections
+    return sorted(name for name in os.listdir(directory) if not name.startswith('.'))
+
+
 def parse_txt(file_lines: list):
     data = pd.Series(file_lines).str.split('#', n=1, expand=True)
     data.columns = ['value', 'description']
     data.value = data.value.astype(float)
     data.description = data.description.str.strip()
-    return data.set_index('description')
\ No newline at end of file
+    return data.set_index('description')
@@ -0,0 +1,35 @@
+# Author: Tobias Bergkvist
+# Purpose: Pack a well geometry into a compact binary format (struct-of-arrays), as an alternative to JSON.
+# Layout (little-endian):
+#   uint32                      length of the JSON header in bytes (a multiple of 4)
+#   JSON header                 { time, centre, casingShoes, count, properties }, padded with spaces
+#   float32[count] * properties one packed array per path segment property, in the order given by "properties"
+# Every array starts at a multiple of 4 bytes, so the client can create Float32Array views without copying.
+
+import numpy as np
+import struct
+import json
+
+from app.instrumentation import staged
+
+media_type = 'application/octet-stream'
+
+
+@staged('encode')
+def pack_well_geometry(geometry: dict) -> bytes:
+    # geometry is the output of well_geometry_arrays
+    path_segments = geometry['pathSegments']
+    properties = list(path_segments)
+    header = json.dumps({
+        'time': geometry['time'],
+        'centre': geometry['centre'],
+        'casingShoes': geometry['casingShoes'],
+        'count': len(path_segments[properties[0]]) if properties else 0,
+        'properties': properties,
+    }, default=float).encode()
+    header += b' ' * (-len(header) % 4)
+    return b''.join(
+        [struct.pack('<I', len(header)), header] +
+        [np.ascontiguousarray(path_segments[name], dtype='<f4').tobytes() for name in properties]
+    )
+
@@ -0,0 +1,94 @@
+# Author: Tobias Bergkvist
+# Purpose: Run the CPU-heavy work (parsing, rendering, geometry) on a pool of processes from async routes,
+# so that neither the event loop nor the cheap routes have to wait for it (or for the GIL).
+# At most max_pending computations are running or queued at a time. Requests beyond that are rejected immediately
+# (and can be retried later), instead of piling up. Requests with the same key as a computation that is
+# already running wait for that computation instead of starting another one.
+# The processes are started fresh (with forkserver or spawn) instead of being forked from the API process,
+# since forking a process with running threads can leave locks held by those threads locked forever in the child.
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import asyncio
+
+
+class Overloaded(Exception):
+    pass
+
+
+class ComputePool:
+    def __init__(self, workers: int, max_queued: int):
+        # workers = 0 runs the computations on a thread pool instead (useful when processes can't be used)
+        self.workers = workers
+        self.max_pending = max(1, workers) + max_queued
+        self.executor = None # Created on first use, so that importing this module doesn't start any processes
+        self.in_flight = {}  # key -> asyncio.Future
+        self.outside = 0     # Admitted work that is done outside of the pool (see admit)
+        self.completed = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.rejected = 0
+
+    async def run(self, key, function, *args):
+        # function and args must be picklable (module-level functions and plain values)
+        flight = self.in_flight.get(key)
+        if flight is not None:
+            self.coalesced += 1
+        elif self.pending() >= self.max_pending:
+            self.rejected += 1
+            raise Overloaded(f'{self.pending()} computations are already running or queued')
+        else:
+            flight = self.in_flight[key] = asyncio.get_event_loop().run_in_executor(self.get_executor(), function, *args)
+            flight.add_done_callback(lambda done: self.finish(key, done))
+        # Shielded, so that the computation keeps going for everyone else if this request is cancelled
+        return await asyncio.shield(flight)
+
+    def admit(self):
+        # For work that is done outside of the pool (like streaming a response from the threads of the API),
+        # but should still count towards max_pending. Raises Overloaded like run, and otherwise returns a function
+        # that must be called once the work is done.
+        if self.pending() >= self.max_pending:
+            self.rejected += 1
+            raise Overloaded(f'{self.pending()} computations are already running or queued')
+        self.outside += 1
+        released = []
+        def release():
+            if not released:
+                released.append(True)
+                self.outside -= 1
+        return release
+
+    def pending(self) -> int:
+        return len(self.in_flight) + self.outside
+
+    def finish(self, key, flight: asyncio.Future):
+        del self.in_flight[key]
+        error = None if flight.cancelled() else flight.exception()
+        if error is None:
+            self.completed += 1
+            return
+        self.failed += 1
+        if isinstance(error, BrokenProcessPool):
+            # A worker died (killed for using too much memory for example). Start over with a new pool.
+            self.executor = None
+
+    def get_executor(self):
+        if self.executor is None:
+            if self.workers > 0:
+                start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context(start_method))
+            else:
+                self.executor = ThreadPoolExecutor()
+        return self.executor
+
+    def stats(self) -> dict:
+        return {
+            'workers': self.workers,
+            'pending': self.pending(),
+            'maxPending': self.max_pending,
+            'completed': self.completed,
+            'failed': self.failed,
+            'coalesced': self.coalesced,
+            'rejected': self.rejected,
+        }
@@ -0,0 +1,78 @@
+# Author: Tobias Bergkvist
+# Purpose: Store arrays derived from the simulation files (the relative simulation data and image pyramids) on disk,
+# as .npy-files next to the binary simulation cache (see SimulationLoader.py). Every process memory-maps the same files,
+# so the operating system keeps a single copy of them in memory for all of the compute pool processes (see main.py),
+# and they are computed only once: a process that finds another one computing them waits for it (using a lock file).
+
+from collections import namedtuple
+import hashlib
+import shutil
+import json
+import os
+import numpy as np
+
+from app.SimulationLoader import locked_file, write_array_chunks, write_atomically
+
+derived_version = 1
+
+# An array that is computed a chunk of rows at a time, so that it never has to be in memory all at once
+ArrayChunks = namedtuple('ArrayChunks', ['chunks', 'columns', 'dtype'])
+
+
+def derived_arrays(cache_dir: str, key: tuple, versions: tuple, compute) -> tuple:
+    # Returns (arrays, meta), where arrays maps names to arrays memory-mapped from the stored .npy-files.
+    # compute() returns (arrays, meta) as well, where an array can also be ArrayChunks, and meta must be json serializable.
+    # key describes what is derived, and versions are those of its source files (see file_versions).
+    # If the files can't be written (read-only data volume for example), the computed arrays are returned instead.
+    key_digest = digest(key)
+    directory = f'{cache_dir}/derived/{key_digest}-{digest((derived_version, versions))}'
+    try:
+        return read_derived(directory)
+    except (OSError, ValueError):
+        pass
+    try:
+        os.makedirs(directory, exist_ok=True)
+        lock = locked_file(f'{directory}/lock')
+    except OSError:
+        arrays, meta = compute()
+        return { name: in_memory(array) for name, array in arrays.items() }, meta
+    with lock:
+        try:
+            return read_derived(directory) # Computed by another process while waiting for the lock
+        except (OSError, ValueError):
+            pass
+        arrays, meta = compute()
+        for name, array in arrays.items():
+            if isinstance(array, ArrayChunks):
+                write_array_chunks(f'{directory}/{name}.npy', array.chunks, array.columns, array.dtype)
+            else:
+                write_atomically(f'{directory}/{name}.npy', lambda f: np.save(f, array))
+        # Written last, since it marks the arrays as complete
+        write_atomically(f'{directory}/meta.json', lambda f: f.write(json.dumps({ 'arrays': list(arrays), 'meta': meta }).encode()))
+    remove_stale(f'{cache_dir}/derived', key_digest, os.path.basename(directory))
+    return read_derived(directory)
+
+
+def read_derived(directory: str) -> tuple:
+    with open(f'{directory}/meta.json') as f:
+        stored = json.load(f)
+    return { name: np.load(f'{directory}/{name}.npy', mmap_mode='r') for name in stored['arrays'] }, stored['meta']
+
+
+def in_memory(array) -> np.ndarray:
+    if not isinstance(array, ArrayChunks):
+        return array
+    chunks = [np.asarray(chunk, dtype=array.dtype) for chunk in array.chunks]
+    return np.concatenate(chunks) if chunks else np.empty((0, array.columns), dtype=array.dtype)
+
+
+def remove_stale(derived_dir: str, key_digest: str, keep: str):
+    # Remove the arrays derived from earlier versions of the source files.
+    # Processes that still have them memory-mapped keep on working, since the files only disappear when they are closed.
+    for name in os.listdir(derived_dir):
+        if name.startswith(f'{key_digest}-') and name != keep:
+            shutil.rmtree(f'{derived_dir}/{name}', ignore_errors=True)
+
+
+def digest(value) -> str:
+    return hashlib.sha1(repr(value).encode()).hexdigest()
@@ -0,0 +1,148 @@
+# Author: Tobias Bergkvist
+# Purpose: Downsample simulation images, and split them into a level-of-detail pyramid of tiles.
+# Level 0 is the full resolution image, and every level after that halves the number of rows and/or columns.
+# Blocks of pixels are combined with min/max/mean, so that short pressure spikes don't disappear when zooming out
+# (which is what happens when the browser scales down a large image).
+
+import numpy as np
+
+from app.instrumentation import staged
+
+aggregations = {
+    'mean': np.add,
+    'min': np.minimum,
+    'max': np.maximum,
+}
+
+
+@staged('render')
+def downsample(data: np.ndarray, row_factor: int, column_factor: int, aggregate: str = 'max') -> np.ndarray:
+    # Combine every row_factor x column_factor block into a single pixel. The last block along an axis may be smaller.
+    check_aggregate(aggregate)
+    values = np.asarray(data, dtype=np.float32)
+    for axis, factor in [(0, row_factor), (1, column_factor)]:
+        if factor <= 1:
+            continue
+        starts = np.arange(0, values.shape[axis], factor)
+        reduced = aggregations[aggregate].reduceat(values, starts, axis=axis)
+        if aggregate == 'mean':
+            block_sizes = np.diff(np.append(starts, values.shape[axis])).astype(np.float32)
+            reduced /= block_sizes[:, np.newaxis] if axis == 0 else block_sizes[np.newaxis, :]
+        values = reduced
+    return values
+
+
+def check_aggregate(aggregate: str):
+    if aggregate not in aggregations:
+        raise ValueError(f"Unknown aggregate '{aggregate}'. Expected one of: {', '.join(aggregations)}")
+
+
+def downsample_to(data: np.ndarray, max_height: int = None, max_width: int = None, aggregate: str = 'max') -> np.ndarray:
+    # Downsample just enough for the image to fit within max_height x max_width
+    return downsample(data, *downsample_factors(np.shape(data), max_height, max_width), aggregate)
+
+
+def downsample_factors(shape: tuple, max_height: int = None, max_width: int = None) -> tuple:
+    height, width = shape
+    return (
+        -(-height // max_height) if max_height else 1,
+        -(-width // max_width) if max_width else 1,
+    )
+
+
+def pyramid_layout(shape: tuple, tile_size: int = 512) -> list:
+    # The (shape, (row_factor, column_factor)) of every level, where the factors are relative to level 0
+    layout = [(tuple(shape), (1, 1))]
+    while max(layout[-1][0]) > tile_size:
+        (rows, columns), (row_factor, column_factor) = layout[-1]
+        # An axis that already fits within a single tile is left alone (there are usually far fewer depths than time steps)
+        row_step, column_step = 2 if rows > tile_size else 1, 2 if columns > tile_size else 1
+        layout.append(((-(-rows // row_step), -(-columns // column_step)), (row_factor * row_step, column_factor * column_step)))
+    return layout
+
+
+@staged('render')
+def image_pyramid(data: np.ndarray, aggregate: str = 'max', tile_size: int = 512) -> dict:
+    layout = pyramid_layout(np.shape(data), tile_size)
+    levels = [np.asarray(data, dtype=np.float32)]
+    for (_, previous_factors), (_, factors) in zip(layout, layout[1:]):
+        levels.append(downsample(levels[-1], factors[0] // previous_factors[0], factors[1] // previous_factors[1], aggregate))
+    return {
+        'levels': levels,
+        'layout': layout,
+        'tileSize': tile_size,
+        # The colour limits come from the full resolution data, so that every tile on every level uses the same scale
+        'vmin': float(np.nanmin(levels[0])),
+        'vmax': float(np.nanmax(levels[0])),
+    }
+
+
+def first_stored_level(layout: list, max_bytes: int) -> int:
+    # The first level that takes up at most max_bytes (as float32). The last level always fits within a single tile.
+    for level, ((rows, columns), _) in enumerate(layout):
+        if 4 * rows * columns <= max_bytes:
+            return level
+    return len(layout) - 1
+
+
+def chunked_image_pyramid(layout: list, first: int, chunks, aggregate: str = 'max', tile_size: int = 512) -> dict:
+    # Like image_pyramid, for images that are too large to keep in memory. The levels before first are not stored (None),
+    # see pyramid_tile. Level first is downsampled directly from chunks, which are blocks of columns of the full resolution
+    # image, where every block but the last has a multiple of the column factor of level first columns.
+    # (The mean can then differ slightly from image_pyramid, which averages averages, because of rounding and
+    # because the last and smaller block of an axis is weighted differently)
+    row_factor, column_factor = layout[first][1]
+    blocks, vmin, vmax = [], np.inf, -np.inf
+    for chunk in chunks:
+        chunk = np.asarray(chunk, dtype=np.float32)
+        vmin, vmax = min(vmin, float(np.nanmin(chunk))), max(vmax, float(np.nanmax(chunk)))
+        blocks.append(downsample(chunk, row_factor, column_factor, aggregate))
+    levels = [None] * first + [np.concatenate(blocks, axis=1)]
+    for (_, previous_factors), (_, factors) in zip(layout[first:], layout[first + 1:]):
+        levels.append(downsample(levels[-1], factors[0] // previous_factors[0], factors[1] // previous_factors[1], aggregate))
+    return { 'levels': levels, 'layout': layout, 'tileSize': tile_size, 'vmin': vmin, 'vmax': vmax }
+
+
+def pyramid_info(pyramid: dict) -> dict:
+    tile_size = pyramid['tileSize']
+    return {
+        'tileSize': tile_size,
+        'vmin': pyramid['vmin'],
+        'vmax': pyramid['vmax'],
+        'levels': [
+            {
+                'height': rows,
+                'width': columns,
+                'tilesMd': -(-rows // tile_size),
+                'tilesTime': -(-columns // tile_size),
+            }
+            for (rows, columns), _ in pyramid['layout']
+        ],
+    }
+
+
+def tile_bounds(pyramid: dict, level: int, t: int, md: int) -> tuple:
+    # The (rows, columns) of the full resolution image covered by a tile, as ranges.
+    # Rows of the image are measure depths, and columns are time steps. Tiles at the edges may be smaller.
+    # Raises IndexError when the tile is outside of the pyramid.
+    tile_size = pyramid['tileSize']
+    if not 0 <= level < len(pyramid['layout']):
+        raise IndexError(f'Level {level} does not exist')
+    (rows, columns), (row_factor, column_factor) = pyramid['layout'][level]
+    if not (0 <= md * tile_size < rows and 0 <= t * tile_size < columns):
+        raise IndexError(f'Tile ({t}, {md}) does not exist on level {level}')
+    full_rows, full_columns = pyramid['layout'][0][0]
+    return (
+        range(md * tile_size * row_factor, min(full_rows, (md + 1) * tile_size * row_factor)),
+        range(t * tile_size * column_factor, min(full_columns, (t + 1) * tile_size * column_factor)),
+    )
+
+
+def pyramid_tile(pyramid: dict, level: int, t: int, md: int) -> np.ndarray:
+    # Returns None if the level is not stored (see chunked_image_pyramid), and raises IndexError like tile_bounds
+    tile_bounds(pyramid, level, t, md)
+    data = pyramid['levels'][level]
+    if data is None:
+        return None
+    tile_size = pyramid['tileSize']
+    return data[md * tile_size:(md + 1) * tile_size, t * tile_size:(t + 1) * tile_size]
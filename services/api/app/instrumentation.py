@@ -0,0 +1,222 @@
+# Author: Tobias Bergkvist
+# Purpose: Measure how long every stage of a request takes (load, parse, gravity_correction, geometry, render, encode,
+# serialize), and how much it increases the resident memory of the process. The measurements are collected in
+# histograms that can be exposed in the Prometheus text format.
+# Stages can be nested (reading chunks while rendering for example), and the time spent in an inner stage is then
+# not counted for the outer one, so that the stages of a request add up to the time spent in total.
+# The memory is that of the whole process, so an outer stage includes what its inner stages keep, and stages running
+# at the same time in other threads are included as well.
+# It also has a sampling profiler, which records the call stacks of the threads working on a request at regular intervals.
+
+from contextlib import contextmanager
+import contextvars
+import functools
+import threading
+import resource
+import time
+import sys
+import os
+
+# The stages of the request that is currently being handled (None when nothing is being measured)
+current_stages = contextvars.ContextVar('current_stages', default=None)
+# The profile (see sampling) of the request that is currently being handled (None when it is not being profiled)
+current_samples = contextvars.ContextVar('current_samples', default=None)
+# The profiler that is sampling the current thread (see sampling and profiled_call)
+current_profiler = contextvars.ContextVar('current_profiler', default=None)
+
+
+class Stages:
+    def __init__(self):
+        self.totals = {} # name -> [seconds, largest memory increase in bytes]
+        self.nested = [] # Time spent in nested stages, for every stage that is currently active
+
+    def add(self, name: str, seconds: float, memory_bytes: int):
+        total = self.totals.setdefault(name, [0.0, 0])
+        total[0] += seconds
+        total[1] = max(total[1], memory_bytes)
+
+    def merge(self, totals: dict):
+        for name, (seconds, memory_bytes) in totals.items():
+            self.add(name, seconds, memory_bytes)
+
+
+@contextmanager
+def stage(name: str):
+    stages = current_stages.get()
+    if stages is None:
+        yield
+        return
+    nested = [0.0]
+    stages.nested.append(nested)
+    start, start_memory = time.perf_counter(), resident_memory()
+    try:
+        yield
+    finally:
+        stages.nested.pop()
+        seconds = time.perf_counter() - start
+        if stages.nested:
+            stages.nested[-1][0] += seconds
+        stages.add(name, seconds - nested[0], max(0, resident_memory() - start_memory))
+
+
+def staged(name: str):
+    # Decorator for measuring a whole function as a stage
+    def decorator(function):
+        @functools.wraps(function)
+        def staged_function(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return staged_function
+    return decorator
+
+
+@contextmanager
+def recording_stages():
+    # Measure the stages of everything done within this block (in the current thread/task)
+    stages = Stages()
+    token = current_stages.set(stages)
+    try:
+        yield stages
+    finally:
+        current_stages.reset(token)
+
+
+def resident_memory() -> int:
+    # Current resident memory of the process in bytes. Only the peak is available without /proc (on macOS for example).
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * page_size
+    except OSError:
+        return peak_memory()
+
+
+page_size = resource.getpagesize()
+
+
+def peak_memory() -> int:
+    # Peak resident memory of the process in bytes (ru_maxrss is in kilobytes on Linux, but in bytes on macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else 1024 * peak
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, buckets: list):
+        self.name = name
+        self.description = description
+        self.buckets = sorted(buckets)
+        self.series = {} # labels (tuple of (name, value)) -> [count per bucket..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, labels: dict, value: float):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def exposition(self) -> list:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for key, series in sorted(self.series.items()):
+                labels = ','.join(f'{name}="{escape(value)}"' for name, value in key)
+                for bucket, count in zip(self.buckets, series):
+                    lines.append(f'{self.name}_bucket{{{labels},le="{number(bucket)}"}} {count}')
+                lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {series[-1]}')
+                lines.append(f'{self.name}_sum{{{labels}}} {number(series[-2])}')
+                lines.append(f'{self.name}_count{{{labels}}} {series[-1]}')
+        return lines
+
+
+def number(value) -> str:
+    # Without rounding (unlike :g), and integers without a decimal point
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def escape(label_value) -> str:
+    return str(label_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class SamplingProfiler:
+    # Records the call stack of the thread that created it (and of the threads added with add_thread) every interval
+    # seconds, until stop() is called. The samples are counted per stack, as "outermost;...;innermost"
+    # (the folded format used by flame graph tools). Anything shorter than the interval may not be sampled at all.
+    def __init__(self, interval: float = 0.001):
+        self.interval = interval
+        self.thread_ids = { threading.get_ident() }
+        self.samples = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add_thread(self, thread_id: int):
+        self.thread_ids.add(thread_id)
+
+    def remove_thread(self, thread_id: int):
+        self.thread_ids.discard(thread_id)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+            for thread_id in list(self.thread_ids):
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    stack.append(f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}')
+                    frame = frame.f_back
+                if stack:
+                    folded = ';'.join(reversed(stack))
+                    self.samples[folded] = self.samples.get(folded, 0) + 1
+
+    def stop(self) -> dict:
+        self.stopped.set()
+        self.thread.join()
+        return self.samples
+
+
+@contextmanager
+def sampling(enabled: bool):
+    # Yields a dict that is filled with the samples (see SamplingProfiler) when the block is done, or None if not enabled
+    if not enabled:
+        yield None
+        return
+    samples = {}
+    profiler = SamplingProfiler()
+    token = current_profiler.set(profiler)
+    try:
+        yield samples
+    finally:
+        current_profiler.reset(token)
+        samples.update(profiler.stop())
+
+
+def profiled_call(function, *args):
+    # Returns a function that calls function(*args), for running on another thread (of a thread pool for example).
+    # That thread is then sampled as well by the profiler of the current thread (if there is one) while doing so.
+    profiler = current_profiler.get()
+    def call():
+        if profiler is None:
+            return function(*args)
+        profiler.add_thread(threading.get_ident())
+        try:
+            return function(*args)
+        finally:
+            profiler.remove_thread(threading.get_ident())
+    return call
+
+
+def merge_samples(samples: dict, more_samples: dict):
+    for stack, count in more_samples.items():
+        samples[stack] = samples.get(stack, 0) + count
+
+
+def folded_samples(samples: dict) -> str:
+    return ''.join(f'{stack} {count}\n' for stack, count in sorted(samples.items()))
+
+
+def metric(name: str, description: str, kind: str, value: float) -> list:
+    # A single gauge or counter without labels, in the Prometheus text format
+    return [f'# HELP {name} {description}', f'# TYPE {name} {kind}', f'{name} {number(value)}']
@@ -1,24 +1,155 @@
 # Author: Tobias Bergkvist
 # Purpose: Connect modules together, and serve API routes
 
-from starlette.responses import FileResponse
+from starlette.requests import Request
+from starlette.routing import Match
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.status import HTTP_304_NOT_MODIFIED, HTTP_400_BAD_REQUEST, HTTP_404_NOT_FOUND, HTTP_503_SERVICE_UNAVAILABLE
 from fastapi.security.api_key import APIKey
-from fastapi import Depends, FastAPI
-import tempfile
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, params
+from urllib.parse import quote
+import subprocess
+import threading
+import fcntl
+import aiofiles
+import asyncio
+import hashlib
+import inspect
+import random
+import time
+import uuid
+import sys
+import re
 import os
-import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
 
 import app.turbo_colormap_data
 from app.get_api_key import get_api_key
-from app.SimulationLoader import SimulationLoader
-from app.relative_simulation_data import relative_simulation_data
+from app.SimulationLoader import SimulationLoader, simulation_names, index_range, rows_per_chunk, visible_entries
+from app.simulation_cache import SimulationCache, file_versions
+from app.derived_arrays import ArrayChunks, derived_arrays
+from app.png_renderer import render_png, render_png_chunks
+from app.image_pyramid import check_aggregate, downsample, downsample_factors, downsample_to, image_pyramid, chunked_image_pyramid, first_stored_level, pyramid_layout, pyramid_info, pyramid_tile, tile_bounds
+from app.relative_simulation_data import relative_simulation_chunks
 from app.path_segments  import path_segments  as create_path_segments
 from app.geometry_types import geometry_types as create_geometry_types
-from app.well_geometry  import well_geometry  as create_well_geometry
+from app.well_geometry  import well_geometry_arrays, records, final_path_properties
+from app.binary_geometry import pack_well_geometry, media_type as binary_geometry_media_type
+from app.precomputed import precomputed_path, precomputed_version, read_precomputed, write_precomputed
+from app.compute_pool import ComputePool, Overloaded
+from app.instrumentation import Histogram, current_samples, current_stages, folded_samples, merge_samples, metric, profiled_call, recording_stages, sampling, stage
 
 app = FastAPI()
 simulation_dir = './data/HeaveSim simulations'
+# Every process that does computations (see compute_pool) has a cache of this size. The large arrays (relative simulation
+# data and image pyramids) are memory-mapped from disk (see derived_arrays.py), and shared between the processes.
+cache_bytes = int(os.environ.get('SIMULATION_CACHE_MB', 512)) * 2**20
+cache = SimulationCache(max_bytes=cache_bytes)
+# Simulation data larger than this (as float64) is processed in chunks instead of all at once
+streaming_threshold = int(os.environ.get('STREAMING_THRESHOLD_MB', 256)) * 2**20
+geometry_files = ['pipepressure.csv', 'geometrydef.txt', 'well_path.csv']
+# How long (in seconds) browsers may reuse a response without asking again. Asking again is cheap because of the ETags.
+cache_max_age = int(os.environ.get('CACHE_MAX_AGE', 3600))
+# Store every computed image/geometry response on disk (not only those from precompute.py), so it is never computed twice
+response_cache = os.environ.get('RESPONSE_CACHE', '0') != '0'
+# When set, responses stored on disk are sent by the proxy instead of the API, using X-Accel-Redirect. The value is
+# an internal location of the proxy that serves the simulation directory (not part of services/proxy/nginx.conf yet).
+accel_redirect_prefix = os.environ.get('ACCEL_REDIRECT_PREFIX')
+# Add a Server-Timing header with the time spent in every stage (see instrumentation.py) to all responses
+server_timing = os.environ.get('SERVER_TIMING', '0') != '0'
+# When set, sampling profiles are written to this directory, for requests with the header "X-Profile: 1"
+# and for a random PROFILE_SAMPLE_RATE fraction of all requests
+profile_dir = os.environ.get('PROFILE_DIR')
+profile_sample_rate = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+
+duration_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+request_seconds = Histogram('heavesim_request_duration_seconds', 'Time spent handling requests.', duration_buckets)
+stage_seconds = Histogram('heavesim_stage_duration_seconds', 'Time spent in every stage of handling requests.', duration_buckets)
+stage_memory = Histogram(
+    'heavesim_stage_memory_increase_bytes',
+    'Increase of the resident memory of the process doing the work during every stage of handling requests (memory freed again within the stage is not included).',
+    [2**20 * 4**i for i in range(7)]
+)
+
+
+compute_workers = int(os.environ.get('COMPUTE_WORKERS', os.cpu_count() or 1))
+compute_pool = ComputePool(
+    workers=compute_workers,
+    max_queued=int(os.environ.get('COMPUTE_QUEUE', 2 * max(1, compute_workers))),
+)
+# The latest cache statistics of every compute pool process, by process id (see in_worker)
+worker_cache_stats = {}
+
+
+@app.on_event('startup')
+def precompute_on_startup():
+    # Warm up every well/connection (see precompute.py) in a separate process, so that requests can be served meanwhile.
+    # Every worker process of the API runs this, so only the one that gets the lock file starts the precompute.
+    # The precompute process keeps the lock until it is done (and the system releases it if the process dies).
+    if os.environ.get('PRECOMPUTE_ON_STARTUP', '0') == '0':
+        return
+    try:
+        lock = open(f'{simulation_dir}/.precompute.lock', 'w')
+    except OSError as error:
+        print(f'Not precomputing, since the lock file could not be created: {error}')
+        return
+    with lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return # Another worker process is already precomputing
+        process = subprocess.Popen([sys.executable, '-m', 'app.precompute', '--simulation-dir', simulation_dir], pass_fds=[lock.fileno()])
+    # Wait for the process in the background, so that it doesn't stay around as a zombie when it is done
+    threading.Thread(target=process.wait, daemon=True).start()
+
+
+@app.middleware('http')
+async def instrument(request: Request, call_next):
+    # Measure every request and its stages (see instrumentation.py), and possibly profile it.
+    # A profile consists of the samples of the event loop (which includes any other requests handled at the same time),
+    # of the threads doing work for the request (see profiled_call), and of the compute pool (see computed).
+    # The body of a streamed response is sent after the profile has been written, so it isn't included.
+    profiled = profile_dir is not None and (request.headers.get('x-profile') == '1' or random.random() < profile_sample_rate)
+    start = time.perf_counter()
+    samples_token = current_samples.set({} if profiled else None)
+    try:
+        with recording_stages() as stages, sampling(profiled) as request_samples:
+            response = await call_next(request)
+        samples = current_samples.get()
+    finally:
+        current_samples.reset(samples_token)
+    if profiled:
+        merge_samples(samples, request_samples)
+    seconds = time.perf_counter() - start
+    route = route_path(request)
+    request_seconds.observe({ 'route': route, 'method': request.method, 'status': response.status_code }, seconds)
+    for name, (stage_duration, memory_increase) in stages.totals.items():
+        stage_seconds.observe({ 'route': route, 'stage': name }, stage_duration)
+        stage_memory.observe({ 'route': route, 'stage': name }, memory_increase)
+    if server_timing:
+        timings = [(name, totals[0]) for name, totals in stages.totals.items()] + [('total', seconds)]
+        response.headers['Server-Timing'] = ', '.join(f'{name};dur={1000 * duration:.1f}' for name, duration in timings)
+    if profiled:
+        response.headers['X-Profile'] = await write_profile(route, samples)
+    return response
+
+def route_path(request: Request) -> str:
+    # The path of the matching route (like /api/simulations/{well}), so that metrics are not split up per well/connection
+    for route in app.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return 'unmatched'
+
+async def write_profile(route: str, samples: dict) -> str:
+    # Returns the name of the file (in profile_dir) with the samples in the folded format (see instrumentation.py)
+    file_name = f"{time.strftime('%Y%m%d-%H%M%S')}-{re.sub('[^A-Za-z0-9]+', '_', route).strip('_')}-{uuid.uuid4().hex[:8]}.folded"
+    os.makedirs(profile_dir, exist_ok=True)
+    async with aiofiles.open(f'{profile_dir}/{file_name}', 'w') as f:
+        await f.write(folded_samples(samples))
+    return file_name
 
 
 @app.get('/api')
@@ -26,51 +157,519 @@ def get():
     return "Hello from the specialization project API of Tobias Bergkvist."
 
 @app.get('/api/simulations')
-def get_wells_and_connections(api_key: APIKey = Depends(get_api_key)):
-    wells = sorted(os.listdir(simulation_dir))
+async def get_wells_and_connections(request: Request, api_key: APIKey = Depends(get_api_key)):
+    return await listing_response(request, wells_and_connections)
+
+@app.get('/api/simulations/{well}')
+async def get_connections(request: Request, well: str, api_key: APIKey = Depends(get_api_key)):
+    return await listing_response(request, connections, well)
+
+def wells_and_connections() -> dict:
+    wells = visible_entries(simulation_dir)
     dirs = { 
-        well: sorted(os.listdir(f'{simulation_dir}/{well}'))
+        well: visible_entries(f'{simulation_dir}/{well}')
         for well in wells 
     }
     return dirs
 
-@app.get('/api/simulations/{well}')
-def get_connections(well: str, api_key: APIKey = Depends(get_api_key)):
-    return sorted(os.listdir(f'{simulation_dir}/{well}'))
+def connections(well: str) -> list:
+    return visible_entries(f'{simulation_dir}/{well}')
+
+def simplification_options(
+    tolerance: float = Query(None, gt=0),
+    max_segments: int = Query(None, ge=1, description='Upper limit for the number of path segments. At least one segment per geometry type (and gap in the path) is kept, so fewer than that is not possible.'),
+    angle_tolerance: float = Query(1.0, gt=0),
+) -> tuple:
+    # Query parameters for merging nearly collinear path segments (see simplify_path_segments.py).
+    # tolerance is in meters and angle_tolerance in degrees. Without tolerance and max_segments, nothing is merged.
+    return (tolerance, max_segments, angle_tolerance)
+
+def dependency_defaults(dependency):
+    # What a dependency (like simplification_options) returns for a request without any of its query parameters
+    def default(parameter: inspect.Parameter):
+        if isinstance(parameter.default, params.Depends):
+            return dependency_defaults(parameter.default.dependency)
+        return getattr(parameter.default, 'default', parameter.default) # Query(default, ...) or a plain default value
+    return dependency(**{ name: default(parameter) for name, parameter in inspect.signature(dependency).parameters.items() })
+
+no_simplification = dependency_defaults(simplification_options)
 
 @app.get('/api/simulations/{well}/{connection}')
-def get_well_geometry(well: str, connection: str, radius_scaling: float = 100, api_key: APIKey = Depends(get_api_key)):
-    sl = SimulationLoader(f'{simulation_dir}/{well}/{connection}')
-    simulation_data = sl.pipepressure()
-    geometry_types = create_geometry_types(sl.geometrydef())
-    path_segments = create_path_segments(sl.well_path(), geometry_types, np.array(simulation_data.columns), radius_scaling)
-    return create_well_geometry(path_segments, geometry_types, simulation_data)
+async def get_well_geometry(request: Request, well: str, connection: str, radius_scaling: float = 100, simplification: tuple = Depends(simplification_options), response_format: str = Query(None, alias='format'), accept: str = Header(None), api_key: APIKey = Depends(get_api_key)):
+    # JSON by default. The binary layout (see binary_geometry.py) is used with ?format=binary,
+    # or when the client says it accepts application/octet-stream.
+    if response_format == 'binary' or (response_format is None and binary_geometry_media_type in (accept or '')):
+        artifact = well_geometry_artifact(well, connection, radius_scaling, 'binary', simplification)
+        return await artifact_response(request, artifact, binary_geometry_media_type, { 'Vary': 'Accept' })
+    artifact = well_geometry_artifact(well, connection, radius_scaling, 'json', simplification)
+    return await artifact_response(request, artifact, 'application/json', { 'Vary': 'Accept' })
 
-@app.get('/api/simulations/{well}/{connection}/pipepressure.png')
-def get_pipepressure_image(well: str, connection: str, cmap: str = 'inferno', vmin: float = None, vmax: float = None, api_key: APIKey = Depends(get_api_key)):
-    sl = SimulationLoader(f'{simulation_dir}/{well}/{connection}')
-    pressure_per_meter = sl.fluiddef().iloc[0][0] * 9.81 * 1e-5
-    data = relative_simulation_data(sl.well_path(), sl.pipepressure().transpose(), pressure_per_meter)
+def window_options(
+    t_start: float = None,
+    t_stop: float = None,
+    md_start: float = None,
+    md_stop: float = None,
+    stride: int = Query(1, ge=1),
+) -> tuple:
+    # Query parameters for only using a block of the simulation: times in [t_start, t_stop] (every stride'th time step),
+    # and measure depths in [md_start, md_stop].
+    return (t_start, t_stop, md_start, md_stop, stride)
 
-    with tempfile.NamedTemporaryFile(mode='w+b', suffix='.png', delete=False) as image:
-        plt.imsave(image.name, data, cmap=cmap, vmin=vmin, vmax=vmax)
-        return FileResponse(image.name, media_type='image/png', headers={ 'Cache-Control': 'max-age=120' })
+full_window = dependency_defaults(window_options)
 
-@app.get('/api/simulations/{well}/{connection}/annuluspressure.png')
-def get_annuluspressure_image(well: str, connection: str, cmap: str = 'inferno', vmin: float = None, vmax: float = None, api_key: APIKey = Depends(get_api_key)):
-    sl = SimulationLoader(f'{simulation_dir}/{well}/{connection}')
-    pressure_per_meter = sl.fluiddef().iloc[0][0] * 9.81 * 1e-5
-    data = relative_simulation_data(sl.well_path(), sl.annuluspressure().transpose(), pressure_per_meter)
+def image_options(
+    window: tuple = Depends(window_options),
+    cmap: str = 'inferno',
+    vmin: float = None,
+    vmax: float = None,
+    compression: int = Query(1, ge=0, le=9),
+    max_width: int = Query(None, ge=1),
+    max_height: int = Query(None, ge=1),
+    aggregate: str = 'max',
+) -> dict:
+    # Query parameters shared by all the image routes.
+    # max_width/max_height downsample the image (combining blocks of pixels using the aggregate) until it fits.
+    return {
+        'window': window,
+        'cmap': cmap,
+        'vmin': vmin,
+        'vmax': vmax,
+        'compression': compression,
+        'max_width': max_width,
+        'max_height': max_height,
+        'aggregate': aggregate,
+    }
+
+default_image_options = dependency_defaults(image_options)
+
+@app.get('/api/simulations/{well}/{connection}/pipepressure.png')
+async def get_pipepressure_image(request: Request, well: str, connection: str, options: dict = Depends(image_options), api_key: APIKey = Depends(get_api_key)):
+    return await artifact_response(request, simulation_image_artifact(well, connection, 'pipepressure', options), 'image/png')
 
-    with tempfile.NamedTemporaryFile(mode='w+b', suffix='.png', delete=False) as image:
-        plt.imsave(image.name, data, cmap=cmap, vmin=vmin, vmax=vmax)
-        return FileResponse(image.name, media_type='image/png', headers={ 'Cache-Control': 'max-age=120' })
+@app.get('/api/simulations/{well}/{connection}/annuluspressure.png')
+async def get_annuluspressure_image(request: Request, well: str, connection: str, options: dict = Depends(image_options), api_key: APIKey = Depends(get_api_key)):
+    return await artifact_response(request, simulation_image_artifact(well, connection, 'annuluspressure', options), 'image/png')
 
 @app.get('/api/simulations/{well}/{connection}/pipestress.png')
-def get_pipestress_image(well: str, connection: str, cmap: str = 'inferno', vmin: float = None, vmax: float = None, api_key: APIKey = Depends(get_api_key)):
+async def get_pipestress_image(request: Request, well: str, connection: str, options: dict = Depends(image_options), api_key: APIKey = Depends(get_api_key)):
+    return await artifact_response(request, simulation_image_artifact(well, connection, 'pipestress', options), 'image/png')
+
+@app.get('/api/simulations/{well}/{connection}/{simulation}/data')
+async def get_simulation_data(request: Request, well: str, connection: str, simulation: str, relative: bool = False, window: tuple = Depends(window_options), api_key: APIKey = Depends(get_api_key)):
+    # Binary little-endian response, consisting of (in order):
+    # the times as float64[rows], the measure depths as float64[columns] and the values as float32[rows, columns].
+    files = relative_simulation_files(simulation) # Also validates the simulation name
+    files = files if relative else [f'{simulation}.csv']
+    async def respond():
+        if await computed(is_too_large_for_memory, well, connection, simulation, window):
+            # Streamed a chunk of time steps at a time instead (which is too much to send back from the compute pool),
+            # from the threads of the API. The stream counts towards the limit of the compute pool until it is done.
+            release = admitted()
+            try:
+                content, rows, columns = await run_in_threadpool(profiled_call(simulation_data_stream, well, connection, simulation, relative, window))
+            except BaseException:
+                release()
+                raise
+            response = StreamingResponse(in_threadpool(content, release), media_type='application/octet-stream')
+        else:
+            content, rows, columns = await computed(simulation_data_content, well, connection, simulation, relative, window)
+            response = Response(content, media_type='application/octet-stream')
+        response.headers['X-Shape'] = f'{rows},{columns}'
+        response.headers['X-Layout'] = f'time:float64[{rows}],md:float64[{columns}],values:float32[{rows},{columns}]'
+        return response
+    return await conditional_response(request, entity_tag(well, connection, files, 'data', simulation, relative, window), respond)
+
+@app.get('/api/simulations/{well}/{connection}/{simulation}/tiles')
+async def get_image_pyramid_info(request: Request, well: str, connection: str, simulation: str, aggregate: str = 'max', api_key: APIKey = Depends(get_api_key)):
+    async def respond():
+        return JSONResponse(await computed(image_pyramid_info, well, connection, simulation, aggregate))
+    etag = entity_tag(well, connection, relative_simulation_files(simulation), 'tiles', simulation, aggregate)
+    return await conditional_response(request, etag, respond)
+
+@app.get('/api/simulations/{well}/{connection}/{simulation}/tiles/{level}/{t}/{md}.png')
+async def get_image_tile(request: Request, well: str, connection: str, simulation: str, level: int, t: int, md: int, cmap: str = 'inferno', vmin: float = None, vmax: float = None, compression: int = Query(1, ge=0, le=9), aggregate: str = 'max', api_key: APIKey = Depends(get_api_key)):
+    parameters = (level, t, md, cmap, vmin, vmax, compression, aggregate)
+    async def respond():
+        return png_response(await computed(image_tile_png, well, connection, simulation, *parameters))
+    etag = entity_tag(well, connection, relative_simulation_files(simulation), 'tile', simulation, parameters)
+    return await conditional_response(request, etag, respond)
+
+@app.get('/api/cache')
+def get_cache_stats(api_key: APIKey = Depends(get_api_key)):
+    return { **cache_stats(), 'computePool': compute_pool.stats() }
+
+@app.get('/api/metrics')
+def get_metrics(api_key: APIKey = Depends(get_api_key)):
+    # Prometheus text format. Stages and caches of the compute pool processes are included.
+    pool, total_cache_stats = compute_pool.stats(), cache_stats()
+    lines = request_seconds.exposition() + stage_seconds.exposition() + stage_memory.exposition() + [
+        *metric('heavesim_compute_pool_pending', 'Computations running or queued in the compute pool.', 'gauge', pool['pending']),
+        *metric('heavesim_compute_pool_completed_total', 'Computations completed by the compute pool.', 'counter', pool['completed']),
+        *metric('heavesim_compute_pool_failed_total', 'Computations that failed in the compute pool.', 'counter', pool['failed']),
+        *metric('heavesim_compute_pool_coalesced_total', 'Requests that shared a computation with an identical request.', 'counter', pool['coalesced']),
+        *metric('heavesim_compute_pool_rejected_total', 'Requests rejected because the compute pool queue was full.', 'counter', pool['rejected']),
+        *metric('heavesim_cache_bytes', 'Approximate size of the in-memory cache.', 'gauge', total_cache_stats['bytes']),
+        *metric('heavesim_cache_hits_total', 'In-memory cache hits.', 'counter', total_cache_stats['hits']),
+        *metric('heavesim_cache_misses_total', 'In-memory cache misses.', 'counter', total_cache_stats['misses']),
+    ]
+    return Response('\n'.join(lines) + '\n', media_type='text/plain; version=0.0.4')
+
+
+def cache_stats() -> dict:
+    # With COMPUTE_WORKERS=0 the computations use the cache of this process. Otherwise that cache is unused, and the
+    # statistics of the compute pool processes (as of their latest computation) are added together instead.
+    # Processes that have been replaced (after a crash) keep their last statistics. maxBytes is the budget of every process.
+    if compute_workers == 0:
+        return cache.stats()
+    all_stats = list(worker_cache_stats.values())
+    total = { key: sum(stats[key] for stats in all_stats) for key in cache.stats() }
+    return { **total, 'maxBytes': cache_bytes, 'processes': len(all_stats) }
+
+def entity_tag(well: str, connection: str, files: list, *request) -> str:
+    # A strong ETag, which changes whenever one of the source files, the request (path and parameters) or the code changes
+    versions = file_versions(f'{simulation_dir}/{well}/{connection}', files)
+    return '"' + hashlib.sha1(repr((precomputed_version, versions, request)).encode()).hexdigest() + '"'
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    # The proxy may have turned the ETag into a weak one (when compressing the response for example)
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+async def conditional_response(request: Request, etag: str, respond, cache_control: str = None):
+    # respond() is only awaited if the client doesn't already have the response with this etag,
+    # so answering with 304 Not Modified doesn't load any data.
+    headers = { 'ETag': etag, 'Cache-Control': cache_control or f'private, max-age={cache_max_age}' }
+    if is_not_modified(request, etag):
+        return Response(status_code=HTTP_304_NOT_MODIFIED, headers=headers)
+    response = await respond()
+    for name, value in headers.items():
+        response.headers[name] = value
+    return response
+
+async def listing_response(request: Request, function, *args):
+    # Listings are cheap to make, but new wells/connections can show up at any time, so they are always revalidated
+    with stage('load'):
+        listing = await asyncio.get_event_loop().run_in_executor(None, profiled_call(function, *args))
+    with stage('serialize'):
+        content = JSONResponse(listing).body
+    etag = '"' + hashlib.sha1(content).hexdigest() + '"'
+    async def respond():
+        return Response(content, media_type='application/json')
+    return await conditional_response(request, etag, respond, 'private, no-cache')
+
+async def artifact_response(request: Request, artifact: tuple, media_type: str, headers: dict = {}):
+    # Response for an image/geometry, which is stored on disk if it has been precomputed (see precomputed.py)
+    file_path, function, args = artifact
+    async def respond():
+        if accel_redirect_prefix is not None and os.path.exists(file_path):
+            # Let the proxy send the file
+            location = os.path.relpath(file_path, simulation_dir).split(os.sep)
+            return Response(media_type=media_type, headers={ **headers, 'X-Accel-Redirect': accel_redirect_prefix + '/' + '/'.join(map(quote, location)) })
+        return Response(await precomputed_or_computed(artifact), media_type=media_type, headers=headers)
+    # The precomputed path is derived from the source file versions and the request, so it works as an ETag as well
+    return await conditional_response(request, '"' + os.path.splitext(os.path.basename(file_path))[0] + '"', respond)
+
+async def computed(function, *args):
+    # Run function(*args) on the compute pool (see compute_pool.py). Identical requests share a single computation.
+    # The stages (and profile) of the computation are added to those of the current request.
+    samples = current_samples.get()
+    try:
+        result, error, stages, worker_samples, (pid, stats) = await compute_pool.run((function.__name__, repr(args)), in_worker, simulation_dir, samples is not None, function, *args)
+    except Overloaded as error:
+        raise overloaded(error)
+    worker_cache_stats[pid] = stats
+    if current_stages.get() is not None:
+        current_stages.get().merge(stages)
+    if samples is not None and worker_samples is not None:
+        merge_samples(samples, worker_samples)
+    if error is not None:
+        raise HTTPException(status_code=error[0], detail=error[1])
+    return result
+
+def admitted():
+    # Admit work that is done outside of the compute pool (see ComputePool.admit)
+    try:
+        return compute_pool.admit()
+    except Overloaded as error:
+        raise overloaded(error)
+
+def overloaded(error: Overloaded) -> HTTPException:
+    return HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail=str(error), headers={ 'Retry-After': '1' })
+
+def in_worker(api_simulation_dir: str, profile: bool, function, *args) -> tuple:
+    # Returns (result, error, stages, samples, (pid, cache_stats)), where stages are the totals of every stage
+    # (see instrumentation.py), samples is the sampling profile (or None if profile is False), and cache_stats
+    # are the statistics of the cache of the process that did the computation.
+    # HTTPExceptions can't be pickled, so they are sent back as (status_code, detail).
+    # The compute pool processes import this module from scratch, so simulation_dir is passed along in case it was changed.
+    global simulation_dir
+    simulation_dir = api_simulation_dir
+    with recording_stages() as stages, sampling(profile) as samples:
+        try:
+            result, error = function(*args), None
+        except HTTPException as http_error:
+            result, error = None, (http_error.status_code, http_error.detail)
+    return result, error, stages.totals, samples, (os.getpid(), cache.stats())
+
+def simulation_data_content(well: str, connection: str, simulation: str, relative: bool, window: tuple) -> tuple:
+    # Returns (content, rows, columns) for get_simulation_data
+    if relative:
+        data = load_relative_simulation_data(well, connection, simulation, window).transpose()
+    else:
+        relative_simulation_files(simulation) # Only for validating the simulation name
+        data = SimulationLoader(f'{simulation_dir}/{well}/{connection}').simulation_slice(simulation, *window)
+    rows, columns = data.shape
+    with stage('serialize'):
+        content = b''.join([
+            np.asarray(data.index.values, dtype='<f8').tobytes(),
+            np.asarray(data.columns.values, dtype='<f8').tobytes(),
+            np.asarray(data.values, dtype='<f4').tobytes(),
+        ])
+    return content, rows, columns
+
+def simulation_data_stream(well: str, connection: str, simulation: str, relative: bool, window: tuple) -> tuple:
+    # Like simulation_data_content, except that content is an iterator over the bytes, which only has a chunk
+    # of time steps in memory at a time (for windows that are too large for memory)
+    time, md, _ = windowed_axes(well, connection, simulation, window)
+    if relative:
+        _, chunks = relative_simulation_chunk_source(well, connection, simulation, window)
+    else:
+        chunks = lambda: SimulationLoader(f'{simulation_dir}/{well}/{connection}').simulation_chunks(simulation, *window)
+    def content():
+        yield np.asarray(time, dtype='<f8').tobytes()
+        yield np.asarray(md, dtype='<f8').tobytes()
+        for chunk in chunks():
+            yield np.asarray(chunk, dtype='<f4').tobytes()
+    return content(), len(time), len(md)
+
+async def in_threadpool(iterator, release):
+    # Iterate in the threadpool, so that reading the chunks doesn't block the event loop.
+    # release (see admitted) is called when done, also if the client goes away before that.
+    done = object()
+    try:
+        while True:
+            item = await run_in_threadpool(profiled_call(next, iterator, done))
+            if item is done:
+                return
+            yield item
+    finally:
+        release()
+
+def image_pyramid_info(well: str, connection: str, simulation: str, aggregate: str) -> dict:
+    return pyramid_info(load_image_pyramid(well, connection, simulation, aggregate))
+
+def image_tile_png(well: str, connection: str, simulation: str, level: int, t: int, md: int, cmap: str, vmin: float, vmax: float, compression: int, aggregate: str) -> bytes:
+    pyramid = load_image_pyramid(well, connection, simulation, aggregate)
+    try:
+        tile = pyramid_tile(pyramid, level, t, md)
+    except IndexError as error:
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail=str(error))
+    if tile is None:
+        tile = streamed_pyramid_tile(well, connection, simulation, pyramid, level, t, md, aggregate)
+    vmin = pyramid['vmin'] if vmin is None else vmin
+    vmax = pyramid['vmax'] if vmax is None else vmax
+    return or_400(render_png, tile, cmap=cmap, vmin=vmin, vmax=vmax, compression=compression)
+
+def streamed_pyramid_tile(well: str, connection: str, simulation: str, pyramid: dict, level: int, t: int, md: int, aggregate: str) -> np.ndarray:
+    # The levels that are too large to keep in memory (see load_image_pyramid) are downsampled from the simulation
+    # data when a tile is requested, reading only the time steps that the tile covers
+    rows, columns = tile_bounds(pyramid, level, t, md)
+    row_factor, column_factor = pyramid['layout'][level][1]
+    time, _, _ = SimulationLoader(f'{simulation_dir}/{well}/{connection}').simulation_axes(simulation)
+    window = (float(time[columns.start]), float(time[columns.stop - 1]), None, None, 1)
+    (_, mds), _ = relative_simulation_chunk_source(well, connection, simulation, window)
+    _, chunks = relative_simulation_chunk_source(well, connection, simulation, window, column_factor * max(1, rows_per_chunk(mds) // column_factor))
+    blocks = [downsample(chunk.T[rows.start:rows.stop], row_factor, column_factor, aggregate) for chunk in chunks()]
+    return np.concatenate(blocks, axis=1)
+
+
+def load_well_geometry(well: str, connection: str, radius_scaling: float, layout: str = 'json', simplification: tuple = no_simplification):
+    # layout is either 'arrays' (see well_geometry_arrays), 'json' (the default response, encoded) or 'binary' (see binary_geometry.py)
+    # simplification is (tolerance, max_segments, angle_tolerance), see simplification_options
+    data_dir = f'{simulation_dir}/{well}/{connection}'
+    versions = file_versions(data_dir, geometry_files)
+    def compute_arrays():
+        sl = SimulationLoader(data_dir)
+        simulation_data = sl.pipepressure()
+        geometry_types = create_geometry_types(sl.geometrydef())
+        path_segments = create_path_segments(sl.well_path(), geometry_types, np.array(simulation_data.columns), radius_scaling)
+        tolerance, max_segments, angle_tolerance = simplification
+        return well_geometry_arrays(path_segments, geometry_types, simulation_data, tolerance=tolerance, max_segments=max_segments, angle_tolerance=angle_tolerance)
+    def compute():
+        geometry = load_well_geometry(well, connection, radius_scaling, 'arrays', simplification)
+        if layout == 'binary':
+            return pack_well_geometry(geometry)
+        with stage('serialize'):
+            return JSONResponse({ **geometry, 'pathSegments': records(geometry['pathSegments'], final_path_properties) }).body
+    return cache.get(('well_geometry', well, connection, versions, radius_scaling, layout, simplification), compute_arrays if layout == 'arrays' else compute)
+
+def load_relative_simulation_data(well: str, connection: str, simulation: str, window: tuple = full_window) -> pd.DataFrame:
+    # Rows are measure depths and columns are time steps (limited to the window, see window_options).
+    # A view of the relative simulation data of all time steps and measure depths, which is stored on disk.
+    data_dir = f'{simulation_dir}/{well}/{connection}'
+    versions = file_versions(data_dir, relative_simulation_files(simulation))
+    def compute():
+        time, md, values, index_name = relative_simulation_arrays(well, connection, simulation)
+        t_start, t_stop, md_start, md_stop, stride = window
+        rows = slice(*index_range(time, t_start, t_stop), stride)
+        columns = slice(*index_range(md, md_start, md_stop))
+        return pd.DataFrame(values[rows, columns].T, index=pd.Index(md[columns]), columns=pd.Index(time[rows], name=index_name), copy=False)
+    return cache.get(('relative_simulation_data', well, connection, versions, simulation, window), compute)
+
+def relative_simulation_arrays(well: str, connection: str, simulation: str) -> tuple:
+    # Returns (time, md, values, index_name) like SimulationLoader.simulation_arrays, where values is the relative
+    # simulation data (with time steps as rows), which is computed a chunk at a time, and stored on disk (see derived_arrays.py)
+    data_dir = f'{simulation_dir}/{well}/{connection}'
+    versions = file_versions(data_dir, relative_simulation_files(simulation))
+    sl = SimulationLoader(data_dir)
+    time, md, index_name = sl.simulation_axes(simulation)
+    def compute():
+        _, chunks = relative_simulation_chunk_source(well, connection, simulation, full_window)
+        return { 'values': ArrayChunks(chunks(), len(md), np.float64) }, {}
+    arrays, _ = cache.get(
+        ('relative_simulation_arrays', well, connection, versions, simulation),
+        lambda: derived_arrays(sl.cache_dir, ('relative_simulation_data', simulation), versions, compute)
+    )
+    return time, md, arrays['values'], index_name
+
+def relative_simulation_chunk_source(well: str, connection: str, simulation: str, window: tuple, chunk_rows: int = None) -> tuple:
+    # Returns (shape, chunks), where shape is (time steps, measure depths) and chunks() iterates over
+    # the relative simulation data (not transposed) chunk_rows time steps at a time.
+    # The pressures are made relative to the hydrostatic pressure of the drilling fluid.
+    # For the stress, a fixed factor is used instead.
     sl = SimulationLoader(f'{simulation_dir}/{well}/{connection}')
-    data = relative_simulation_data(sl.well_path(), sl.pipestress().transpose(), -0.75)
+    time, md, _ = windowed_axes(well, connection, simulation, window)
+    well_path = sl.well_path()
+    pressure_per_meter = sl.fluiddef().iloc[0][0] * 9.81 * 1e-5 if simulation != 'pipestress' else -0.75
+    def chunks():
+        values = sl.simulation_chunks(simulation, *window, chunk_rows=chunk_rows)
+        return relative_simulation_chunks(well_path, pd.Index(md), values, pressure_per_meter)
+    return (len(time), len(md)), chunks
+
+def windowed_axes(well: str, connection: str, simulation: str, window: tuple) -> tuple:
+    # Returns (time, md, index_name) of the simulation, limited to the window (see window_options), without reading the values
+    time, md, index_name = SimulationLoader(f'{simulation_dir}/{well}/{connection}').simulation_axes(simulation)
+    t_start, t_stop, md_start, md_stop, stride = window
+    return time[slice(*index_range(time, t_start, t_stop), stride)], md[slice(*index_range(md, md_start, md_stop))], index_name
+
+def relative_simulation_files(simulation: str) -> list:
+    if simulation not in simulation_names:
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail=f"Unknown simulation '{simulation}'")
+    return [f'{simulation}.csv', 'well_path.csv'] + (['fluiddef.txt'] if simulation != 'pipestress' else [])
+
+def is_too_large_for_memory(well: str, connection: str, simulation: str, window: tuple) -> bool:
+    relative_simulation_files(simulation) # Only for validating the simulation name
+    time, md, _ = windowed_axes(well, connection, simulation, window)
+    return 8 * len(time) * len(md) > streaming_threshold
+
+def load_downsampled_data(well: str, connection: str, simulation: str, window: tuple, max_height: int, max_width: int, aggregate: str) -> dict:
+    data_dir = f'{simulation_dir}/{well}/{connection}'
+    versions = file_versions(data_dir, relative_simulation_files(simulation))
+    def compute():
+        data = load_relative_simulation_data(well, connection, simulation, window).values
+        return {
+            'values': or_400(downsample_to, data, max_height, max_width, aggregate),
+            # Keep the colour limits of the full resolution image
+            'vmin': float(np.nanmin(data)),
+            'vmax': float(np.nanmax(data)),
+        }
+    def compute_in_chunks():
+        # Every chunk has a whole number of downsampled columns, so the chunks can be downsampled independently
+        (columns, rows), _ = relative_simulation_chunk_source(well, connection, simulation, window)
+        row_factor, column_factor = downsample_factors((rows, columns), max_height, max_width)
+        _, chunks = relative_simulation_chunk_source(well, connection, simulation, window, column_factor * max(1, rows_per_chunk(rows) // column_factor))
+        blocks, vmin, vmax = [], np.inf, -np.inf
+        for chunk in chunks():
+            vmin, vmax = min(vmin, np.nanmin(chunk)), max(vmax, np.nanmax(chunk))
+            blocks.append(or_400(downsample, chunk.T, row_factor, column_factor, aggregate))
+        return { 'values': np.concatenate(blocks, axis=1), 'vmin': float(vmin), 'vmax': float(vmax) }
+    key = ('downsampled_data', well, connection, versions, simulation, window, max_height, max_width, aggregate)
+    if key not in cache and is_too_large_for_memory(well, connection, simulation, window):
+        return cache.get(key, compute_in_chunks)
+    return cache.get(key, compute)
+
+def load_image_pyramid(well: str, connection: str, simulation: str, aggregate: str) -> dict:
+    # The levels are stored on disk (see derived_arrays.py), and the rest of the pyramid in their meta data
+    data_dir = f'{simulation_dir}/{well}/{connection}'
+    versions = file_versions(data_dir, relative_simulation_files(simulation))
+    def compute():
+        data = load_relative_simulation_data(well, connection, simulation).values
+        return or_400(image_pyramid, data, aggregate)
+    def compute_in_chunks():
+        # Only the levels that fit within the streaming threshold are kept, and the first of them is downsampled
+        # chunk by chunk. Every chunk has a whole number of its downsampled columns (like in load_downsampled_data).
+        (columns, rows), _ = relative_simulation_chunk_source(well, connection, simulation, full_window)
+        layout = pyramid_layout((rows, columns))
+        first = first_stored_level(layout, streaming_threshold)
+        column_factor = layout[first][1][1]
+        _, chunks = relative_simulation_chunk_source(well, connection, simulation, full_window, column_factor * max(1, rows_per_chunk(rows) // column_factor))
+        return or_400(chunked_image_pyramid, layout, first, (chunk.T for chunk in chunks()), aggregate)
+    def compute_stored():
+        pyramid = compute_in_chunks() if is_too_large_for_memory(well, connection, simulation, full_window) else compute()
+        levels = { f'level{i}': level for i, level in enumerate(pyramid['levels']) if level is not None }
+        return levels, { key: value for key, value in pyramid.items() if key != 'levels' }
+    def load():
+        or_400(check_aggregate, aggregate) # Before anything is stored under its name
+        levels, meta = derived_arrays(SimulationLoader(data_dir).cache_dir, ('image_pyramid', simulation, aggregate), versions, compute_stored)
+        layout = [(tuple(shape), tuple(factors)) for shape, factors in meta['layout']]
+        return { **meta, 'layout': layout, 'levels': [levels.get(f'level{i}') for i in range(len(layout))] }
+    return cache.get(('image_pyramid', well, connection, versions, simulation, aggregate), load)
+
+def or_400(function, *args, **kwargs):
+    # Invalid query parameters (like an unknown colormap) cause a ValueError deeper down
+    try:
+        return function(*args, **kwargs)
+    except ValueError as error:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=str(error))
+
+async def precomputed_or_computed(artifact: tuple) -> bytes:
+    # Use the response stored by precompute.py if there is one, and compute it on the compute pool otherwise
+    file_path, function, args = artifact
+    with stage('load'):
+        content = await read_precomputed(file_path)
+    if content is not None:
+        return content
+    if response_cache:
+        return await computed(stored, file_path, function, *args)
+    return await computed(function, *args)
+
+def stored(file_path: str, function, *args) -> bytes:
+    # function(*args), which is also stored where precomputed_or_computed looks for it the next time
+    content = function(*args)
+    write_precomputed(file_path, content)
+    return content
+
+def well_geometry_artifact(well: str, connection: str, radius_scaling: float, layout: str, simplification: tuple) -> tuple:
+    # Returns (precomputed_path, function, args), where function(*args) returns the response body for the 'json' or 'binary' layout
+    data_dir = f'{simulation_dir}/{well}/{connection}'
+    request = ('well_geometry', float(radius_scaling), layout, simplification)
+    extension = '.bin' if layout == 'binary' else '.json'
+    file_path = precomputed_path(data_dir, request, file_versions(data_dir, geometry_files), extension)
+    return file_path, load_well_geometry, (well, connection, radius_scaling, layout, simplification)
+
+def simulation_image_artifact(well: str, connection: str, simulation: str, options: dict) -> tuple:
+    # Returns (precomputed_path, function, args), where function(*args) returns the png
+    data_dir = f'{simulation_dir}/{well}/{connection}'
+    request = ('simulation_image', simulation, tuple(sorted(options.items())))
+    file_path = precomputed_path(data_dir, request, file_versions(data_dir, relative_simulation_files(simulation)), '.png')
+    return file_path, simulation_png, (well, connection, simulation, options)
+
+def simulation_png(well: str, connection: str, simulation: str, options: dict) -> bytes:
+    window, cmap, compression = options['window'], options['cmap'], options['compression']
+    if options['max_height'] is not None or options['max_width'] is not None:
+        downsampled = load_downsampled_data(well, connection, simulation, window, options['max_height'], options['max_width'], options['aggregate'])
+        vmin = downsampled['vmin'] if options['vmin'] is None else options['vmin']
+        vmax = downsampled['vmax'] if options['vmax'] is None else options['vmax']
+        return or_400(render_png, downsampled['values'], cmap=cmap, vmin=vmin, vmax=vmax, compression=compression)
+    if is_too_large_for_memory(well, connection, simulation, window):
+        # Stream through the data in chunks instead of keeping the full relative data in memory (and in the cache)
+        (columns, rows), chunks = relative_simulation_chunk_source(well, connection, simulation, window)
+        return or_400(render_png_chunks, chunks, (rows, columns), cmap=cmap, vmin=options['vmin'], vmax=options['vmax'], compression=compression)
+    data = load_relative_simulation_data(well, connection, simulation, window).values
+    return or_400(render_png, data, cmap=cmap, vmin=options['vmin'], vmax=options['vmax'], compression=compression)
 
-    with tempfile.NamedTemporaryFile(mode='w+b', suffix='.png', delete=False) as image:
-        plt.imsave(image.name, data, cmap=cmap, vmin=vmin, vmax=vmax)
-        return FileResponse(image.name, media_type='image/png', headers={ 'Cache-Control': 'max-age=120' })
\ No newline at end of file
+def png_response(image: bytes):
+    return Response(image, media_type='image/png')
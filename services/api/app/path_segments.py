@@ -1,82 +1,92 @@
 # Author: Tobias Bergkvist
 # Purpose: Generate the cylinders/path segments so that they are ready for the client to draw them
-# Path segment properties: posx, posy, posz, rotx, roty, rotz, radius, length, imageRow (and vecx, vecy, vecz), 
+# Path segment properties: posx, posy, posz, rotx, roty, rotz, radius, length, imageRow (and vecx, vecy, vecz),
+# The segments are returned as a dict of equally long numpy arrays (one per property), instead of a DataFrame,
+# so that every property can be computed with a few vectorized operations on contiguous arrays.
 
-from scipy.spatial.transform import Rotation as R
 import scipy.interpolate
 import pandas as pd
 import numpy as np
 
+from app.instrumentation import staged
 
-def path_segments(well_path: pd.DataFrame, geometry_types: list, simulation_mds: np.array, radius_scaling: float):
-    segment_length = length(well_path)
-    segment_rotation = rotation(well_path)
-    segment_vector = vector(segment_length, segment_rotation)
-    segment_position = position(segment_vector)
-    segment_radius = radius(well_path, geometry_types) * radius_scaling
-    segment_image_row = image_row(well_path, simulation_mds)
-    return pd.concat([ well_path, segment_length, segment_rotation, segment_vector, segment_position, segment_radius, segment_image_row ], axis=1)
 
+@staged('geometry')
+def path_segments(well_path: pd.DataFrame, geometry_types: list, simulation_mds: np.array, radius_scaling: float) -> dict:
+    assert set(['md', 'inc', 'azi', 'tvd']).issubset(well_path.columns)
+    md = well_path.md.to_numpy(dtype=float)
+    segment_length = length(md)
+    rotx, roty, rotz = rotation(well_path.azi.to_numpy(dtype=float), well_path.inc.to_numpy(dtype=float))
+    vecx, vecy, vecz = vector(segment_length, roty, rotz)
+    posx, posy, posz = position(vecx, vecy, vecz)
+    return {
+        'md': md,
+        'inc': well_path.inc.to_numpy(),
+        'azi': well_path.azi.to_numpy(),
+        'tvd': well_path.tvd.to_numpy(),
+        'length': segment_length,
+        'rotx': rotx,
+        'roty': roty,
+        'rotz': rotz,
+        'vecx': vecx,
+        'vecy': vecy,
+        'vecz': vecz,
+        'posx': posx,
+        'posy': posy,
+        'posz': posz,
+        'radius': radius(md, geometry_types) * radius_scaling,
+        'imageRow': image_row(md, simulation_mds),
+    }
 
-def length(well_path: pd.DataFrame) -> pd.Series:
-    assert set(['md']).issubset(well_path.columns)
-    return pd.Series(
-        well_path.md - well_path.md.shift(1, fill_value=0.0),
-        name='length'
-    )
 
-def rotation(well_path: pd.DataFrame) -> pd.DataFrame:
-    assert set(['azi', 'inc']).issubset(well_path.columns)
-    return pd.DataFrame({
-        # rotx here is never actually used, but is included for completeness 
-        'rotx': 0.0,
-        'roty': np.radians(well_path.azi), 
-        'rotz': np.radians(well_path.inc),
-    })
+def length(md: np.ndarray) -> np.ndarray:
+    return md - np.concatenate([[0.0], md[:-1]])
+
+def rotation(azi: np.ndarray, inc: np.ndarray) -> tuple:
+    # rotx here is never actually used, but is included for completeness
+    return np.zeros(len(azi)), np.radians(azi), np.radians(inc)
 
-def vector(length: pd.Series, rotation: pd.DataFrame) -> pd.DataFrame:
-    assert len(length) == len(rotation)
-    assert set(['roty', 'rotz']).issubset(rotation.columns)
-    return pd.DataFrame({
-        #      Ry(roty)              Rz(rotz)        vector before rotation
-        # [  cos   0   sin ]   [ cos  -sin    0  ]   [    0    ]
-        # [   0    1    0  ] . [ sin   cos    0  ] . [ -length ] 
-        # [ -sin   0   cos ]   [  0     0     1  ]   [    0    ]
+def vector(length: np.ndarray, roty: np.ndarray, rotz: np.ndarray) -> tuple:
+    #      Ry(roty)              Rz(rotz)        vector before rotation
+    # [  cos   0   sin ]   [ cos  -sin    0  ]   [    0    ]
+    # [   0    1    0  ] . [ sin   cos    0  ] . [ -length ]
+    # [ -sin   0   cos ]   [  0     0     1  ]   [    0    ]
 
-        # The matrices above have been pre-multiplied out on paper to yield the expressions below:
-        'vecx': length * np.cos(rotation.roty) * np.sin(rotation.rotz),
-        'vecy': - length * np.cos(rotation.rotz),
-        'vecz': - length * np.sin(rotation.roty) * np.sin(rotation.rotz)
-    })
+    # The matrices above have been pre-multiplied out on paper to yield the expressions below:
+    sin_rotz = np.sin(rotz)
+    return (
+        length * np.cos(roty) * sin_rotz,
+        - length * np.cos(rotz),
+        - length * np.sin(roty) * sin_rotz,
+    )
 
-def position(vector: pd.DataFrame) -> pd.DataFrame:
-    assert set(['vecx', 'vecy', 'vecz']).issubset(vector.columns)
-    position_vectors = vector.cumsum() - 0.5 * vector
-    return pd.DataFrame({
-        'posx': position_vectors.vecx,
-        'posy': position_vectors.vecy,
-        'posz': position_vectors.vecz
-    })
+def position(vecx: np.ndarray, vecy: np.ndarray, vecz: np.ndarray) -> tuple:
+    # The position of a cylinder is its centre, halfway between the end of the previous segment and its own end
+    return tuple(np.cumsum(vec) - 0.5 * vec for vec in (vecx, vecy, vecz))
 
-def radius(well_path: pd.DataFrame, geometry_types: list) -> pd.Series:
-    assert set(['md']).issubset(well_path.columns)
-    radius = sum([
-        geometry_type['radius'] * ((well_path.md > geometry_type['md_start']) & (well_path.md <= geometry_type['md_stop']))
-        for geometry_type in geometry_types
-    ])
-    return pd.Series(radius, name='radius')
+def radius(md: np.ndarray, geometry_types: list) -> np.ndarray:
+    # The radius is that of the geometry type where md_start < md <= md_stop (or 0 if there is none).
+    # Geometry types usually follow each other directly, so a single binary search is enough to find them.
+    starts = np.array([geometry_type['md_start'] for geometry_type in geometry_types], dtype=float)
+    stops = np.array([geometry_type['md_stop'] for geometry_type in geometry_types], dtype=float)
+    radii = np.array([geometry_type['radius'] for geometry_type in geometry_types], dtype=float)
+    if len(radii) > 0 and np.array_equal(starts[1:], stops[:-1]):
+        boundaries = np.append(starts, stops[-1])
+        index = np.searchsorted(boundaries, md, side='left') - 1
+        inside = (index >= 0) & (index < len(radii))
+        return np.where(inside, radii[np.clip(index, 0, len(radii) - 1)], 0.0)
+    # Overlapping or separated geometry types: add up the radius of every type the md falls within
+    return sum([
+        geometry_radius * ((md > md_start) & (md <= md_stop))
+        for md_start, md_stop, geometry_radius in zip(starts, stops, radii)
+    ], np.zeros(len(md)))
 
-def image_row(well_path: pd.DataFrame, simulation_mds: np.array) -> pd.Series:
+def image_row(md: np.ndarray, simulation_mds: np.array) -> np.ndarray:
     # Interpolation to find out what the measure depth pixels should be...
     # Basically, this is connecting an image/texture row to each of the pipe segments
-    assert set(['md']).issubset(well_path.columns)
     interpolation = scipy.interpolate.interp1d(
-        simulation_mds, 
+        simulation_mds,
         np.linspace(0, 1, len(simulation_mds)),
         fill_value='extrapolate'
     )
-    return pd.Series(
-        interpolation(well_path.md),
-        name='imageRow'
-    )
-
+    return interpolation(md)
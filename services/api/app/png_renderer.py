@@ -0,0 +1,125 @@
+# Author: Tobias Bergkvist
+# Purpose: Render simulation data as a colormapped PNG directly into memory.
+# This replaces plt.imsave, which needs a temporary file and goes through global pyplot state.
+# Values are mapped through a precomputed 256-entry lookup table, and the PNG is encoded with zlib.
+
+from functools import lru_cache
+import matplotlib
+import numpy as np
+import struct
+import zlib
+
+from app.turbo_colormap_data import turbo_colormap_data
+from app.instrumentation import staged
+
+lut_size = 256
+
+
+@lru_cache(maxsize=None)
+def colormap_lut(cmap: str) -> np.ndarray:
+    # (256, 4) uint8 RGBA lookup table. Raises ValueError for unknown colormaps.
+    if cmap == 'turbo':
+        rgb = np.round(255 * np.array(turbo_colormap_data)).astype(np.uint8)
+        lut = np.concatenate([rgb, np.full((len(rgb), 1), 255, dtype=np.uint8)], axis=1)
+    else:
+        if cmap not in matplotlib.colormaps:
+            raise ValueError(f"Unknown colormap '{cmap}'. Expected one of: {', '.join(sorted(matplotlib.colormaps))}")
+        lut = matplotlib.colormaps[cmap](np.linspace(0, 1, lut_size), bytes=True)
+    lut.setflags(write=False)
+    return lut
+
+
+def colormap_indices(data: np.ndarray, vmin: float = None, vmax: float = None) -> np.ndarray:
+    # Same binning as matplotlib: values below vmin get the first colour, and values above vmax get the last.
+    values = np.asarray(data, dtype=np.float32)
+    if vmin is None:
+        vmin = float(np.nanmin(values))
+    if vmax is None:
+        vmax = float(np.nanmax(values))
+    scale = lut_size / (vmax - vmin) if vmax > vmin else 0.0
+    indices = values - np.float32(vmin)
+    indices *= np.float32(scale)
+    np.clip(indices, 0, lut_size - 1, out=indices)
+    return indices.astype(np.uint8)
+
+
+@staged('render')
+def render_png(data: np.ndarray, cmap: str = 'inferno', vmin: float = None, vmax: float = None, compression: int = 1) -> bytes:
+    # compression is the zlib level: 0 means uncompressed (fastest, largest), 1 is fast deflate and 9 is the smallest.
+    values = np.asarray(data, dtype=np.float32)
+    missing = np.isnan(values)
+    if missing.any():
+        indices = colormap_indices(np.where(missing, np.float32(0), values), *finite_limits(values, vmin, vmax))
+        return encode_indexed_png(indices, colormap_lut(cmap), missing, compression)
+    return encode_indexed_png(colormap_indices(values, vmin, vmax), colormap_lut(cmap), None, compression)
+
+
+@staged('render')
+def render_png_chunks(chunks, shape: tuple, cmap: str = 'inferno', vmin: float = None, vmax: float = None, compression: int = 1) -> bytes:
+    # Same as render_png for data that is too large to keep in memory as floats.
+    # chunks is a function returning an iterator over blocks of image columns, where each block is transposed
+    # (time steps x measure depths, like they are stored). It is called twice when vmin/vmax have to be found first.
+    # Only the colormap indices of the image are kept in memory (a single byte per pixel).
+    height, width = shape
+    if vmin is None or vmax is None:
+        limits = [finite_limits(np.asarray(chunk, dtype=np.float32), vmin, vmax) for chunk in chunks() if np.size(chunk) > 0]
+        vmin = min(limit[0] for limit in limits)
+        vmax = max(limit[1] for limit in limits)
+    indices = np.empty((height, width), dtype=np.uint8)
+    missing = None
+    column = 0
+    for chunk in chunks():
+        values = np.asarray(chunk, dtype=np.float32).T
+        chunk_missing = np.isnan(values)
+        if chunk_missing.any():
+            if missing is None:
+                missing = np.zeros((height, width), dtype=bool)
+            missing[:, column:column + values.shape[1]] = chunk_missing
+            values = np.where(chunk_missing, np.float32(0), values)
+        indices[:, column:column + values.shape[1]] = colormap_indices(values, vmin, vmax)
+        column += values.shape[1]
+    return encode_indexed_png(indices, colormap_lut(cmap), missing, compression)
+
+
+def finite_limits(values: np.ndarray, vmin: float, vmax: float) -> tuple:
+    return (
+        float(np.nanmin(values)) if vmin is None else vmin,
+        float(np.nanmax(values)) if vmax is None else vmax,
+    )
+
+
+@staged('encode')
+def encode_indexed_png(indices: np.ndarray, lut: np.ndarray, missing: np.ndarray = None, compression: int = 1, block_bytes: int = 2**22) -> bytes:
+    # indices is a (height, width) array of positions in the lookup table. Where missing is True, pixels are transparent.
+    # The image is colormapped and compressed about block_bytes of pixels at a time,
+    # so that the full RGB(A) image never has to exist.
+    height, width = indices.shape
+    channels = 3 if missing is None else 4
+    block_rows = max(1, block_bytes // (4 * max(1, width)))
+    compressor = zlib.compressobj(compression)
+    compressed = []
+    for start in range(0, height, block_rows):
+        pixels = lut[indices[start:start + block_rows]][:, :, :channels]
+        if missing is not None:
+            pixels[missing[start:start + block_rows]] = 0
+        # Every scanline starts with a filter type byte (0 = no filter)
+        scanlines = np.zeros((len(pixels), 1 + width * channels), dtype=np.uint8)
+        scanlines[:, 1:] = pixels.reshape(len(pixels), width * channels)
+        compressed.append(compressor.compress(scanlines.tobytes()))
+    compressed.append(compressor.flush())
+    header = struct.pack('>IIBBBBB', width, height, 8, { 3: 2, 4: 6 }[channels], 0, 0, 0)
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        png_chunk(b'IHDR', header),
+        png_chunk(b'IDAT', b''.join(compressed)),
+        png_chunk(b'IEND', b''),
+    ])
+
+
+def png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return b''.join([
+        struct.pack('>I', len(data)),
+        chunk_type,
+        data,
+        struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type)) & 0xffffffff),
+    ])
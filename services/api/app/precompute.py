@@ -0,0 +1,124 @@
+# Author: Tobias Bergkvist
+# Purpose: Build everything derived from the simulation files ahead of time, for every well/connection:
+# the binary simulation cache (see SimulationLoader.py), and the responses the client asks for by default
+# (images and well geometry, see precomputed.py). Connections are processed in parallel, one per process,
+# and connections whose source files haven't changed since the last run are skipped.
+# Run from services/api with: python -m app.precompute [--workers N] [--force]
+# (or set PRECOMPUTE_ON_STARTUP=1 to run it in the background when the API starts, once for all of its worker processes)
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import time
+import os
+
+import app.main as api
+from app.SimulationLoader import SimulationLoader, simulation_names, visible_entries
+from app.simulation_cache import file_versions
+from app.precomputed import precomputed_dir, precomputed_version, read_manifest, write_manifest, write_precomputed
+
+# What the API and the client ask for by default (see createImageUrl and loadWellGeometry in the client)
+image_variants = [
+    api.default_image_options,
+    { **api.default_image_options, 'cmap': 'turbo', 'max_width': 4096, 'max_height': 4096 },
+]
+geometry_variants = [
+    (100.0, 'json'),
+    (100.0, 'binary'),
+    (300.0, 'binary'),
+]
+source_files = [f'{name}.csv' for name in simulation_names] + ['well_path.csv', 'geometrydef.txt', 'fluiddef.txt']
+
+
+def precompute_all(simulation_dir: str, workers: int = None, force: bool = False):
+    # Yields the report of every connection (see precompute_connection) as soon as it is done
+    connections = [
+        (well, connection)
+        for well in visible_entries(simulation_dir)
+        for connection in visible_entries(f'{simulation_dir}/{well}')
+    ]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(precompute_connection, simulation_dir, well, connection, force) for well, connection in connections]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def precompute_connection(simulation_dir: str, well: str, connection: str, force: bool = False) -> dict:
+    # Returns a report: { well, connection, status ('unchanged', 'built' or 'failed'), seconds, stages: { name: seconds } }
+    api.simulation_dir = simulation_dir
+    data_dir = f'{simulation_dir}/{well}/{connection}'
+    start = time.perf_counter()
+    report = { 'well': well, 'connection': connection, 'status': 'unchanged', 'stages': {} }
+    manifest = {
+        'version': precomputed_version,
+        'sources': [list(version) for version in file_versions(data_dir, [f for f in source_files if os.path.exists(f'{data_dir}/{f}')])],
+        'variants': repr((image_variants, geometry_variants)),
+    }
+    if not force and read_manifest(data_dir) == manifest:
+        report['seconds'] = time.perf_counter() - start
+        return report
+
+    def stage(name: str, function, *args):
+        stage_start = time.perf_counter()
+        result = function(*args)
+        report['stages'][name] = time.perf_counter() - stage_start
+        return result
+
+    try:
+        sl = SimulationLoader(data_dir)
+        simulations = [name for name in simulation_names if os.path.exists(sl.path(f'{name}.csv'))]
+        for name in simulations:
+            if force or not sl.is_cache_fresh(name):
+                stage(f'{name} cache', sl.build_cache, name)
+        artifacts = []
+        for name in simulations:
+            for options in image_variants:
+                artifacts.append((f"{name}.png ({options['cmap']}, max {options['max_width']})", api.simulation_image_artifact(well, connection, name, options)))
+        for radius_scaling, layout in geometry_variants:
+            artifacts.append((f'geometry ({layout}, {radius_scaling:g})', api.well_geometry_artifact(well, connection, radius_scaling, layout, api.no_simplification)))
+        for name, (file_path, function, args) in artifacts:
+            stage(name, lambda: write_precomputed(file_path, function(*args)))
+        remove_stale(data_dir, [file_path for _, (file_path, _, _) in artifacts])
+        write_manifest(data_dir, manifest)
+        report['status'] = 'built'
+    except Exception as error:
+        report['status'] = 'failed'
+        report['error'] = f'{type(error).__name__}: {error}'
+    finally:
+        api.cache.clear()
+    report['seconds'] = time.perf_counter() - start
+    return report
+
+
+def remove_stale(data_dir: str, keep: list):
+    # Remove responses for earlier versions of the source files
+    keep = set(os.path.basename(file_path) for file_path in keep) | {'manifest.json'}
+    for file_name in os.listdir(precomputed_dir(data_dir)):
+        if file_name not in keep and not file_name.endswith('.tmp'):
+            os.remove(f'{precomputed_dir(data_dir)}/{file_name}')
+
+
+def format_report(report: dict) -> str:
+    stages = ', '.join(f'{name} {seconds:.2f}s' for name, seconds in report['stages'].items())
+    line = f"{report['well']}/{report['connection']}: {report['status']} in {report['seconds']:.2f}s"
+    if 'error' in report:
+        line += f" ({report['error']})"
+    return f'{line} [{stages}]' if stages else line
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute the cache and default responses for every well/connection.')
+    parser.add_argument('--simulation-dir', default=api.simulation_dir)
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes (default: number of CPUs)')
+    parser.add_argument('--force', action='store_true', help='Rebuild connections even if their source files have not changed')
+    args = parser.parse_args()
+    start = time.perf_counter()
+    counts = {}
+    for report in precompute_all(args.simulation_dir, args.workers, args.force):
+        print(format_report(report), flush=True)
+        counts[report['status']] = counts.get(report['status'], 0) + 1
+    summary = ', '.join(f'{count} {status}' for status, count in sorted(counts.items()))
+    print(f'Done in {time.perf_counter() - start:.2f}s ({summary or "no connections"})')
+
+
+if __name__ == '__main__':
+    main()
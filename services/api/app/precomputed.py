@@ -0,0 +1,66 @@
+# Author: Tobias Bergkvist
+# Purpose: Store responses that have been rendered ahead of time (see precompute.py) next to the simulation files,
+# so that the first request for a connection doesn't have to parse csv files, build geometry or render images.
+# A response is stored under a name derived from the request, the versions of its source files and the version of
+# the code, which means that a stored response can never be served after one of its source files or the code has changed.
+
+import matplotlib
+import aiofiles
+import hashlib
+import scipy
+import json
+import os
+import numpy as np
+import pandas as pd
+
+from app.SimulationLoader import write_atomically
+
+
+def code_version() -> str:
+    # A digest of the source code of the API and the versions of the libraries it computes responses with,
+    # so that it changes with every deployment that could change a response
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha1(repr([np.__version__, pd.__version__, scipy.__version__, matplotlib.__version__]).encode())
+    for file_name in sorted(os.listdir(app_dir)):
+        if file_name.endswith('.py'):
+            with open(f'{app_dir}/{file_name}', 'rb') as f:
+                digest.update(file_name.encode() + b'\0' + f.read())
+    return digest.hexdigest()
+
+precomputed_version = code_version()
+
+
+def precomputed_dir(data_dir: str) -> str:
+    return f'{data_dir}/.cache/precomputed'
+
+
+def precomputed_path(data_dir: str, request: tuple, versions: tuple, extension: str) -> str:
+    digest = hashlib.sha1(repr((precomputed_version, request, versions)).encode()).hexdigest()
+    return f'{precomputed_dir(data_dir)}/{digest}{extension}'
+
+
+async def read_precomputed(file_path: str):
+    # Returns the stored response (bytes), or None if there is none
+    try:
+        async with aiofiles.open(file_path, 'rb') as f:
+            return await f.read()
+    except OSError:
+        return None
+
+
+def write_precomputed(file_path: str, content: bytes):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    write_atomically(file_path, lambda f: f.write(content))
+
+
+def read_manifest(data_dir: str) -> dict:
+    # The manifest describes what was last precomputed for a connection (see precompute.py)
+    try:
+        with open(f'{precomputed_dir(data_dir)}/manifest.json') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_manifest(data_dir: str, manifest: dict):
+    write_precomputed(f'{precomputed_dir(data_dir)}/manifest.json', json.dumps(manifest).encode())
@@ -2,13 +2,35 @@
 # Purpose: Remove the pressure component that depends on vertical height from the simulation data (leaving only relative pressure).
 
 import pandas as pd
+import numpy as np
 import scipy.interpolate
 
+from app.instrumentation import stage, staged
 
+
+@staged('gravity_correction')
 def relative_simulation_data(well_path: pd.DataFrame, simulation_data_transposed: pd.DataFrame, pressure_per_meter: float):
-    assert set(['md', 'tvd']).issubset(well_path)
-    vertical_depth = scipy.interpolate.interp1d(well_path.md, well_path.tvd)
-    simulation_depths = vertical_depth(simulation_data_transposed.index.astype(float))
-    due_to_gravity = pd.Series(pressure_per_meter * simulation_depths, simulation_data_transposed.index)
+    due_to_gravity = pd.Series(
+        gravity_component(well_path, simulation_data_transposed.index, pressure_per_meter),
+        simulation_data_transposed.index
+    )
     relative_data = simulation_data_transposed.subtract(due_to_gravity, axis='rows')
     return relative_data
+
+
+def relative_simulation_chunks(well_path: pd.DataFrame, simulation_mds: pd.Index, chunks, pressure_per_meter: float):
+    # Same as relative_simulation_data, but for an iterable of chunks that are not transposed
+    # (time steps x simulation_mds), so that the full relative data never has to be in memory at once.
+    with stage('gravity_correction'):
+        due_to_gravity = gravity_component(well_path, simulation_mds, pressure_per_meter)
+    for chunk in chunks:
+        with stage('gravity_correction'):
+            relative_chunk = chunk - due_to_gravity
+        yield relative_chunk
+
+
+def gravity_component(well_path: pd.DataFrame, simulation_mds: pd.Index, pressure_per_meter: float) -> np.ndarray:
+    assert set(['md', 'tvd']).issubset(well_path)
+    vertical_depth = scipy.interpolate.interp1d(well_path.md, well_path.tvd)
+    simulation_depths = vertical_depth(simulation_mds.astype(float))
+    return pressure_per_meter * simulation_depths
@@ -0,0 +1,128 @@
+# Author: Tobias Bergkvist
+# Purpose: Reduce the number of path segments (cylinders) the client has to draw, by merging consecutive segments
+# that are close to collinear. This is a Ramer-Douglas-Peucker style simplification of the well path:
+# runs of segments are split at the joint furthest away from the straight line between their ends,
+# worst run first, until every run is within the tolerance (or there are max_segments of them). Runs that exceed
+# the angle tolerance are worse than those that don't, and runs are otherwise ordered by their distance from the line.
+# Segments are never merged across geometry types or gaps in the path, so each merged segment still
+# has a single radius. They are not merged across rows of the image texture either (so that a merged segment shows the
+# same colour as the segments it replaces), unless that is the only way to get down to max_segments.
+# The ends of every geometry type are kept, so the casing shoes still line up with the path.
+
+import heapq
+import numpy as np
+
+
+def simplify_path_segments(path_segments: dict, image_rows: int, geometry_types: list, tolerance: float = None, max_segments: int = None, angle_tolerance: float = 1.0) -> dict:
+    # tolerance: maximum distance (in meters) from a removed joint to the merged segment
+    # max_segments: upper limit for the number of segments (although at least one per geometry type and gap in the path is kept)
+    # angle_tolerance: maximum angle (in degrees) between a merged segment and any of the segments it replaces
+    # The time taken grows with the number of segments that are kept, so nothing is done when nothing would be merged
+    if tolerance is None and (max_segments is None or max_segments >= len(path_segments['md'])):
+        return path_segments
+    segments = Segments(path_segments, image_rows, geometry_types, np.radians(angle_tolerance))
+    tolerance = 0.0 if tolerance is None else tolerance
+    max_segments = np.inf if max_segments is None else max_segments
+
+    runs = []
+    unbreakable_runs = segments.unbreakable_runs()
+    if len(unbreakable_runs) > max_segments:
+        # Merged segments spanning several rows of the image get the row in the middle
+        unbreakable_runs = segments.unbreakable_runs(split_image_rows=False)
+    for first, last in unbreakable_runs:
+        angle_exceeded, distance, split = segments.error(first, last)
+        heapq.heappush(runs, (-angle_exceeded, -distance, first, last, split))
+    while len(runs) < max_segments:
+        negative_angle_exceeded, negative_distance, first, last, split = runs[0]
+        if not negative_angle_exceeded and -negative_distance <= tolerance:
+            break
+        heapq.heappop(runs)
+        for run in [(first, split), (split + 1, last)]:
+            angle_exceeded, distance, run_split = segments.error(*run)
+            heapq.heappush(runs, (-angle_exceeded, -distance, run[0], run[1], run_split))
+
+    firsts, lasts = np.array(sorted((first, last) for _, _, first, last, _ in runs), dtype=int).reshape(-1, 2).T
+    return segments.merge(firsts, lasts)
+
+
+class Segments:
+    def __init__(self, path_segments: dict, image_rows: int, geometry_types: list, angle_tolerance: float):
+        self.path_segments = path_segments
+        self.angle_tolerance = angle_tolerance
+        # Index of the geometry type of every segment (where md_start < md <= md_stop, like in path_segments.radius)
+        md_stops = np.sort([geometry_type['md_stop'] for geometry_type in geometry_types])
+        self.geometry_type = np.searchsorted(md_stops, path_segments['md'], side='left')
+        self.vector = np.column_stack([path_segments['vecx'], path_segments['vecy'], path_segments['vecz']])
+        position = np.column_stack([path_segments['posx'], path_segments['posy'], path_segments['posz']])
+        self.start = position - 0.5 * self.vector
+        self.end = position + 0.5 * self.vector
+        self.image_row = np.rint(path_segments['imageRow'] * (image_rows - 1))
+
+    def unbreakable_runs(self, split_image_rows: bool = True) -> list:
+        # Runs of segments that may be merged: same geometry type (and radius, which can also change within a geometry type
+        # when geometry types overlap), same image row (if split_image_rows), and with each segment starting where the
+        # previous one ended (invisible segments have been filtered away, which can leave gaps in the path).
+        radius, geometry_type = self.path_segments['radius'], self.geometry_type
+        count = len(radius)
+        if count == 0:
+            return []
+        boundary = np.ones(count, dtype=bool)
+        boundary[1:] = (
+            (geometry_type[1:] != geometry_type[:-1]) |
+            (radius[1:] != radius[:-1]) |
+            ((self.image_row[1:] != self.image_row[:-1]) & split_image_rows) |
+            ~np.all(np.isclose(self.start[1:], self.end[:-1]), axis=1)
+        )
+        firsts = np.flatnonzero(boundary)
+        lasts = np.append(firsts[1:] - 1, count - 1)
+        return list(zip(firsts.tolist(), lasts.tolist()))
+
+    def error(self, first: int, last: int) -> tuple:
+        # Returns (angle_exceeded, distance, split), where distance is the largest distance from a joint between first and
+        # last to the straight line from the start of first to the end of last, split is the segment after which that
+        # joint is, and angle_exceeded is whether any of the segments is further than the angle tolerance from that line.
+        if first == last:
+            return False, 0.0, first
+        start, chord = self.start[first], self.end[last] - self.start[first]
+        chord_length_squared = chord @ chord
+        joints = self.end[first:last]
+        along = np.clip((joints - start) @ chord / chord_length_squared, 0, 1) if chord_length_squared > 0 else np.zeros(len(joints))
+        distances = np.linalg.norm(joints - (start + along[:, np.newaxis] * chord), axis=1)
+        split = int(np.argmax(distances))
+        vectors = self.vector[first:last + 1]
+        cosines = vectors @ chord / (np.linalg.norm(vectors, axis=1) * np.sqrt(chord_length_squared) + 1e-300)
+        angle_exceeded = bool(np.arccos(np.clip(cosines, -1, 1)).max() > self.angle_tolerance)
+        return angle_exceeded, float(distances[split]), first + split
+
+    def merge(self, firsts: np.ndarray, lasts: np.ndarray) -> dict:
+        # One cylinder from the start of the first segment to the end of the last segment of every run.
+        # Runs of a single segment are copied as they are.
+        original = self.path_segments
+        vector = self.end[lasts] - self.start[firsts]
+        length = np.linalg.norm(vector, axis=1)
+        single = firsts == lasts
+        # Inverse of the vector expressions in path_segments.vector
+        rotz = np.arccos(np.clip(-vector[:, 1] / np.where(length > 0, length, 1), -1, 1))
+        roty = np.arctan2(-vector[:, 2], vector[:, 0])
+        # The azimuth is undefined for vertical segments, so keep the one from the first segment
+        roty = np.where(np.hypot(vector[:, 0], vector[:, 2]) > 1e-12 * np.maximum(length, 1), roty, original['roty'][firsts])
+        position = self.start[firsts] + 0.5 * vector
+        merged = {
+            'md': original['md'][lasts],
+            'length': length,
+            'rotx': np.zeros(len(firsts)),
+            'roty': roty,
+            'rotz': rotz,
+            'vecx': vector[:, 0],
+            'vecy': vector[:, 1],
+            'vecz': vector[:, 2],
+            'posx': position[:, 0],
+            'posy': position[:, 1],
+            'posz': position[:, 2],
+            'radius': original['radius'][firsts],
+            'imageRow': 0.5 * (original['imageRow'][firsts] + original['imageRow'][lasts]),
+        }
+        return {
+            name: np.where(single, original[name][firsts], values) if name in original else values
+            for name, values in merged.items()
+        }
@@ -0,0 +1,133 @@
+# Author: Tobias Bergkvist
+# Purpose: Keep parsed simulations and derived geometry in memory between requests.
+# Entries are evicted in least-recently-used order when the memory budget is exceeded, and concurrent requests
+# for the same missing key wait for a single computation instead of all computing the same thing.
+# Memory-mapped arrays (see SimulationLoader.py and derived_arrays.py) only count as their in-memory overhead
+# against the budget, since their pages belong to the operating system's file cache, and are shared between processes.
+
+from collections import OrderedDict
+import threading
+import mmap
+import sys
+import os
+import pandas as pd
+import numpy as np
+
+
+class SimulationCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # key -> (value, size)
+        self.current_bytes = 0
+        self.in_flight = {}          # key -> Flight
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def get(self, key, compute):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            flight = self.in_flight.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = self.in_flight[key] = Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not is_leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = compute()
+            self.put(key, flight.value)
+            return flight.value
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            flight.done.set()
+
+    def __contains__(self, key) -> bool:
+        with self.lock:
+            return key in self.entries
+
+    def put(self, key, value):
+        size = size_of(value)
+        with self.lock:
+            if key in self.entries:
+                self.current_bytes -= self.entries.pop(key)[1]
+            if size > self.max_bytes:
+                # Would evict everything else and still not fit, so don't keep it at all.
+                return
+            self.entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.current_bytes,
+                'maxBytes': self.max_bytes,
+            }
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+def size_of(value) -> int:
+    # Approximate number of bytes held by a cached value
+    if isinstance(value, pd.DataFrame):
+        size = int(value.memory_usage(index=True).sum())
+        return size - value.values.nbytes if is_memory_mapped(value.values) else size
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True))
+    if isinstance(value, np.ndarray):
+        return sys.getsizeof(value) if is_memory_mapped(value) else value.nbytes
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(size_of(k) + size_of(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(size_of(x) for x in value)
+    return sys.getsizeof(value)
+
+
+def is_memory_mapped(array: np.ndarray) -> bool:
+    # Whether the array (or the array it is a view of) is memory-mapped from a file
+    while isinstance(array, np.ndarray):
+        array = array.base
+    return isinstance(array, mmap.mmap)
+
+
+def file_versions(data_dir: str, file_names: list) -> tuple:
+    # Part of a cache key, so that an entry is never reused after one of its source files has changed
+    def version(file_name: str):
+        stat = os.stat(f'{data_dir}/{file_name}')
+        return (file_name, stat.st_mtime_ns, stat.st_size)
+    return tuple(version(file_name) for file_name in file_names)
@@ -5,53 +5,83 @@ from scipy.spatial.transform import Rotation as R
 import pandas as pd
 import numpy as np
 
+from app.simplify_path_segments import simplify_path_segments
+from app.instrumentation import staged
 
-def well_geometry(path_segments: pd.DataFrame, geometry_types: list, simulation_data: pd.DataFrame) -> dict:
-    final_path_properties = ['posx', 'posy', 'posz', 'rotx', 'roty', 'rotz', 'length', 'radius', 'imageRow']
-    assert set(final_path_properties + ['vecx', 'vecy', 'vecz']).issubset(path_segments.columns)
-    visible_path_segments = path_segments[(path_segments.radius > 0.0) & (path_segments.length > 0.0)]
+final_path_properties = ['posx', 'posy', 'posz', 'rotx', 'roty', 'rotz', 'length', 'radius', 'imageRow']
+
+
+def well_geometry(path_segments: dict, geometry_types: list, simulation_data: pd.DataFrame, **simplification) -> dict:
+    geometry = well_geometry_arrays(path_segments, geometry_types, simulation_data, **simplification)
+    return { **geometry, 'pathSegments': records(geometry['pathSegments'], final_path_properties) }
+
+
+@staged('geometry')
+def well_geometry_arrays(path_segments: dict, geometry_types: list, simulation_data: pd.DataFrame, **simplification) -> dict:
+    # Same as well_geometry, but with pathSegments as a dict of arrays (one per property) instead of a list of dicts.
+    # simplification (tolerance, max_segments, angle_tolerance) is passed on to simplify_path_segments.
+    # The casing shoes are always found using all of the path segments.
+    assert set(final_path_properties + ['vecx', 'vecy', 'vecz']).issubset(path_segments)
+    visible = (path_segments['radius'] > 0.0) & (path_segments['length'] > 0.0)
+    visible_path_segments = simplify_path_segments(
+        { name: values[visible] for name, values in path_segments.items() },
+        len(simulation_data.columns),
+        geometry_types,
+        **simplification
+    )
     return {
-        # This "time" part is a bit out of place as part of the well geometry. 
+        # This "time" part is a bit out of place as part of the well geometry.
         # It would probably make more sense to have this included with the image data somehow
         'time': time_domain(simulation_data),
         'centre': find_centre(visible_path_segments),
         'casingShoes': casing_shoes(path_segments, geometry_types),
-        'pathSegments': visible_path_segments[final_path_properties].to_dict(orient='records'),
+        'pathSegments': { name: visible_path_segments[name] for name in final_path_properties },
     }
 
 
+def records(path_segments: dict, properties: list) -> list:
+    # Same as DataFrame.to_dict(orient='records'), but without going through pandas for every row
+    columns = [path_segments[name].tolist() for name in properties]
+    return [dict(zip(properties, row)) for row in zip(*columns)]
+
 def time_domain(simulation_data: pd.DataFrame):
     time_index = list(simulation_data.index)
     return {
         'min': time_index[0],
         'max': time_index[-1],
         'step': time_index[1] - time_index[0],
+        'count': len(time_index),
     }
 
-def find_centre(path_segments: pd.DataFrame):
-    position = path_segments[['posx', 'posy', 'posz']]
-    vector = path_segments[['vecx', 'vecy', 'vecz']]
-    v = vector.rename(columns={ 'vecx': 'posx', 'vecy': 'posy', 'vecz': 'posz' })
-    cylinder_ends = pd.concat([position - v, position + v])
-    centre = 0.5 * (cylinder_ends.max() + cylinder_ends.min())
+def find_centre(path_segments: dict):
+    def centre(axis: str):
+        position, vector = path_segments[f'pos{axis}'], path_segments[f'vec{axis}']
+        cylinder_ends = np.concatenate([position - vector, position + vector])
+        return 0.5 * (cylinder_ends.max() + cylinder_ends.min())
     return {
-        'posx': centre.posx, 
-        'posy': centre.posy,
-        'posz': centre.posz
+        'posx': centre('x'),
+        'posy': centre('y'),
+        'posz': centre('z')
     }
 
-def casing_shoes(path_segments: pd.DataFrame, geometry_types: list) -> list:
-    def casing_shoe(geometry_type: dict):
-        last_segment = path_segments[path_segments.md <= geometry_type['md_stop']].iloc[-1]
-        rotz, roty, rotx = (R.from_euler('xzy', np.array([ np.pi/2, last_segment.rotz, last_segment.roty ]))).as_euler('zyx')
+def casing_shoes(path_segments: dict, geometry_types: list) -> list:
+    if len(geometry_types) == 0:
+        return []
+    # The last segment of every geometry type (path segments are sorted by md)
+    md_stops = [geometry_type['md_stop'] for geometry_type in geometry_types]
+    last = np.searchsorted(path_segments['md'], md_stops, side='right') - 1
+    euler_angles = np.column_stack([np.full(len(last), np.pi/2), path_segments['rotz'][last], path_segments['roty'][last]])
+    rotations = R.from_euler('xzy', euler_angles).as_euler('zyx')
+    def casing_shoe(geometry_type: dict, segment: int, rotation: np.ndarray):
+        rotz, roty, rotx = rotation
         return {
             'label': f"end of {geometry_type['name']}",
-            'posx': last_segment.posx + last_segment.vecx / 2,
-            'posy': last_segment.posy + last_segment.vecy / 2,
-            'posz': last_segment.posz + last_segment.vecz / 2,
+            'posx': path_segments['posx'][segment] + path_segments['vecx'][segment] / 2,
+            'posy': path_segments['posy'][segment] + path_segments['vecy'][segment] / 2,
+            'posz': path_segments['posz'][segment] + path_segments['vecz'][segment] / 2,
             'rotx': rotx,
             'roty': roty,
             'rotz': rotz,
-            'radius': last_segment.radius
+            'radius': path_segments['radius'][segment]
         }
-    return [ casing_shoe(geoemtry_type) for geoemtry_type in geometry_types ]
+    return [ casing_shoe(*shoe) for shoe in zip(geometry_types, last, rotations) ]
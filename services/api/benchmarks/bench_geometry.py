@@ -0,0 +1,98 @@
+# Author: Tobias Bergkvist
+# Purpose: Compare the numpy geometry pipeline (path_segments + well_geometry) with the previous DataFrame-based one,
+# on synthetic well paths with a varying number of survey stations. Also checks that both produce the same JSON,
+# and shows how many path segments are left after simplification (see simplify_path_segments.py).
+# Run from services/api with: python -m benchmarks.bench_geometry [stations...]
+
+from scipy.spatial.transform import Rotation as R
+import scipy.interpolate
+import pandas as pd
+import numpy as np
+import time
+import sys
+
+from app.path_segments import path_segments
+from app.well_geometry import well_geometry, well_geometry_arrays
+from benchmarks.synthetic_simulation import synthetic_well_path, synthetic_geometry_types
+
+
+def dataframe_well_geometry(well_path: pd.DataFrame, geometry_types: list, simulation_data: pd.DataFrame, radius_scaling: float) -> dict:
+    # The previous implementation, kept here as a reference
+    length = pd.Series(well_path.md - well_path.md.shift(1, fill_value=0.0), name='length')
+    rotation = pd.DataFrame({ 'rotx': 0.0, 'roty': np.radians(well_path.azi), 'rotz': np.radians(well_path.inc) })
+    vector = pd.DataFrame({
+        'vecx': length * np.cos(rotation.roty) * np.sin(rotation.rotz),
+        'vecy': - length * np.cos(rotation.rotz),
+        'vecz': - length * np.sin(rotation.roty) * np.sin(rotation.rotz)
+    })
+    position = (vector.cumsum() - 0.5 * vector).rename(columns={ 'vecx': 'posx', 'vecy': 'posy', 'vecz': 'posz' })
+    radius = pd.Series(sum([
+        geometry_type['radius'] * ((well_path.md > geometry_type['md_start']) & (well_path.md <= geometry_type['md_stop']))
+        for geometry_type in geometry_types
+    ]), name='radius') * radius_scaling
+    simulation_mds = np.array(simulation_data.columns)
+    interpolation = scipy.interpolate.interp1d(simulation_mds, np.linspace(0, 1, len(simulation_mds)), fill_value='extrapolate')
+    image_row = pd.Series(interpolation(well_path.md), name='imageRow')
+    segments = pd.concat([ well_path, length, rotation, vector, position, radius, image_row ], axis=1)
+
+    visible = segments[(segments.radius > 0.0) & (segments.length > 0.0)]
+    ends = pd.concat([
+        visible[['posx', 'posy', 'posz']] - visible[['vecx', 'vecy', 'vecz']].values,
+        visible[['posx', 'posy', 'posz']] + visible[['vecx', 'vecy', 'vecz']].values,
+    ])
+    centre = 0.5 * (ends.max() + ends.min())
+    def casing_shoe(geometry_type: dict):
+        last_segment = segments[segments.md <= geometry_type['md_stop']].iloc[-1]
+        rotz, roty, rotx = (R.from_euler('xzy', np.array([ np.pi/2, last_segment.rotz, last_segment.roty ]))).as_euler('zyx')
+        return {
+            'label': f"end of {geometry_type['name']}",
+            'posx': last_segment.posx + last_segment.vecx / 2,
+            'posy': last_segment.posy + last_segment.vecy / 2,
+            'posz': last_segment.posz + last_segment.vecz / 2,
+            'rotx': rotx, 'roty': roty, 'rotz': rotz,
+            'radius': last_segment.radius
+        }
+    time_index = list(simulation_data.index)
+    return {
+        'time': { 'min': time_index[0], 'max': time_index[-1], 'step': time_index[1] - time_index[0], 'count': len(time_index) },
+        'centre': { 'posx': centre.posx, 'posy': centre.posy, 'posz': centre.posz },
+        'casingShoes': [ casing_shoe(geometry_type) for geometry_type in geometry_types ],
+        'pathSegments': visible[['posx', 'posy', 'posz', 'rotx', 'roty', 'rotz', 'length', 'radius', 'imageRow']].to_dict(orient='records'),
+    }
+
+
+def numpy_well_geometry(well_path: pd.DataFrame, geometry_types: list, simulation_data: pd.DataFrame, radius_scaling: float) -> dict:
+    segments = path_segments(well_path, geometry_types, np.array(simulation_data.columns), radius_scaling)
+    return well_geometry(segments, geometry_types, simulation_data)
+
+
+def timed(function, *args) -> tuple:
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def main(*station_counts: int):
+    station_counts = station_counts or (10000, 100000, 1000000)
+    simulation_data = pd.DataFrame(np.zeros((3, 200)), index=[0.0, 0.05, 0.1], columns=np.linspace(0, 5900, 200))
+    geometry_types = synthetic_geometry_types()
+    # "segments ms" is only the numpy path_segments, without building the list of dicts for the JSON response
+    print(f'{"stations":>9} {"DataFrame ms":>13} {"numpy ms":>9} {"speedup":>8} {"segments ms":>12} {"same output":>12}')
+    for stations in station_counts:
+        well_path = synthetic_well_path(stations)
+        dataframe_seconds, expected = timed(dataframe_well_geometry, well_path, geometry_types, simulation_data, 100)
+        numpy_seconds, actual = timed(numpy_well_geometry, well_path, geometry_types, simulation_data, 100)
+        segments_seconds, _ = timed(path_segments, well_path, geometry_types, np.array(simulation_data.columns), 100)
+        print(f'{stations:>9} {1000 * dataframe_seconds:>13.1f} {1000 * numpy_seconds:>9.1f} {dataframe_seconds / numpy_seconds:>7.1f}x {1000 * segments_seconds:>12.1f} {str(expected == actual):>12}')
+    print()
+    print(f'{"stations":>9} {"tolerance m":>12} {"segments":>9} {"simplified":>11} {"arrays ms":>10}')
+    for stations in station_counts:
+        segments = path_segments(synthetic_well_path(stations), geometry_types, np.array(simulation_data.columns), 100)
+        for tolerance in [None, 0.01, 0.1, 1.0]:
+            seconds, geometry = timed(lambda: well_geometry_arrays(segments, geometry_types, simulation_data, tolerance=tolerance))
+            visible = np.count_nonzero((segments['radius'] > 0.0) & (segments['length'] > 0.0))
+            print(f'{stations:>9} {str(tolerance):>12} {visible:>9} {len(geometry["pathSegments"]["length"]):>11} {1000 * seconds:>10.1f}')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
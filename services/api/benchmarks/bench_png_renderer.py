@@ -0,0 +1,52 @@
+# Author: Tobias Bergkvist
+# Purpose: Compare the in-memory PNG renderer with the previous plt.imsave + temporary file approach.
+# Run from services/api with: python -m benchmarks.bench_png_renderer [rows] [columns]
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import tempfile
+import time
+import sys
+import os
+
+from app.png_renderer import render_png
+
+
+def imsave_to_tempfile(data: np.ndarray, cmap: str) -> bytes:
+    with tempfile.NamedTemporaryFile(mode='w+b', suffix='.png', delete=False) as image:
+        plt.imsave(image.name, data, cmap=cmap)
+    with open(image.name, 'rb') as f:
+        png = f.read()
+    os.remove(image.name)
+    return png
+
+
+def best_of(repeats: int, function, *args, **kwargs):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main(rows: int = 2000, columns: int = 20000, repeats: int = 3):
+    # Rows are measure depths and columns are time steps, like the transposed simulation data
+    md = np.linspace(0, 1, rows)[:, np.newaxis]
+    t = np.linspace(0, 200, columns)[np.newaxis, :]
+    data = 10 * np.sin(t + 6 * md) + np.random.default_rng(0).normal(size=(rows, columns))
+
+    print(f'{rows} x {columns} matrix, best of {repeats}')
+    seconds, png = best_of(repeats, imsave_to_tempfile, data, 'inferno')
+    print(f'{"plt.imsave + tempfile":>28}: {1000 * seconds:8.1f} ms {len(png) / 1e6:8.2f} MB')
+    for cmap in ['inferno', 'turbo']:
+        for compression in [0, 1, 6]:
+            seconds, png = best_of(repeats, render_png, data, cmap=cmap, compression=compression)
+            label = f'render_png {cmap} level {compression}'
+            print(f'{label:>28}: {1000 * seconds:8.1f} ms {len(png) / 1e6:8.2f} MB')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,74 @@
+# Author: Tobias Bergkvist
+# Purpose: Compare peak memory (RSS) of rendering a simulation image fully in memory vs. streaming it in chunks.
+# Every measurement runs in a fresh process, since peak RSS can only go up during the lifetime of a process.
+# Run from services/api with: python -m benchmarks.bench_streaming_memory [columns] [rows...]
+
+import subprocess
+import resource
+import tempfile
+import shutil
+import sys
+import os
+
+from app.SimulationLoader import SimulationLoader, read_simulation_csv
+from app.relative_simulation_data import relative_simulation_data, relative_simulation_chunks
+from app.png_renderer import render_png, render_png_chunks
+from benchmarks.synthetic_simulation import write_simulation
+
+
+def render_in_memory(data_dir: str):
+    sl = SimulationLoader(data_dir)
+    data = read_simulation_csv(sl.path('pipepressure.csv'))
+    return render_png(relative_simulation_data(sl.well_path(), data.transpose(), 0.15).values)
+
+
+def render_streaming(data_dir: str):
+    sl = SimulationLoader(data_dir)
+    well_path, data = sl.well_path(), sl.pipepressure()
+    chunks = lambda: relative_simulation_chunks(well_path, data.columns, sl.simulation_chunks('pipepressure'), 0.15)
+    return render_png_chunks(chunks, data.shape[::-1])
+
+
+def measure(mode: str, data_dir: str) -> float:
+    # Peak RSS in MB of a fresh process running the given mode
+    output = subprocess.check_output([sys.executable, '-m', 'benchmarks.bench_streaming_memory', '--measure', mode, data_dir])
+    return float(output.decode().strip().splitlines()[-1])
+
+
+def main(columns: int = 500, *row_counts: int):
+    row_counts = row_counts or (10000, 40000, 160000)
+    print(f'{"rows":>8} {"csv MB":>8} {"imports MB":>11} {"in-memory MB":>13} {"convert MB":>13} {"streaming MB":>13}')
+    for rows in row_counts:
+        data_dir = tempfile.mkdtemp()
+        try:
+            # Generated in a separate process as well, since child processes start out with the peak RSS of their parent
+            subprocess.check_call([sys.executable, '-m', 'benchmarks.bench_streaming_memory', '--generate', data_dir, str(rows), str(columns)])
+            csv_size = os.path.getsize(f'{data_dir}/pipepressure.csv') / 2**20
+            baseline = measure('imports', data_dir)
+            in_memory = measure('in-memory', data_dir)
+            conversion = measure('convert', data_dir)
+            streaming = measure('streaming', data_dir)
+            print(f'{rows:>8} {csv_size:>8.0f} {baseline:>11.0f} {in_memory:>13.0f} {conversion:>13.0f} {streaming:>13.0f}')
+        finally:
+            shutil.rmtree(data_dir)
+
+
+def run_measurement(mode: str, data_dir: str):
+    if mode == 'in-memory':
+        render_in_memory(data_dir)
+    elif mode == 'convert':
+        SimulationLoader(data_dir).build_cache('pipepressure')
+    elif mode == 'streaming':
+        render_streaming(data_dir)
+    # ru_maxrss is in kB on Linux
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--measure']:
+        run_measurement(*sys.argv[2:4])
+    elif sys.argv[1:2] == ['--generate']:
+        # Only the files needed for rendering pipepressure.png
+        write_simulation(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), simulations=['pipepressure'])
+    else:
+        main(*map(int, sys.argv[1:]))
@@ -0,0 +1,350 @@
+# Author: Tobias Bergkvist
+# Purpose: Benchmark every stage of the pipeline (parse, load, gravity_correction, geometry, render, serialize)
+# and the API routes end-to-end, on synthetic simulations of a given size (see synthetic_simulation.py).
+# Reports the p50/p99 latency, throughput and peak memory of every case, and stores the results as json,
+# so that the results of two commits can be compared.
+# Every case runs in a fresh process, since peak RSS can only go up during the lifetime of a process.
+# The routes are called through an in-process ASGI client, with the compute pool running on threads (COMPUTE_WORKERS=0),
+# so that all of the work is measured in the same process.
+# Run from services/api with:
+#   python -m benchmarks.bench_suite run [--size small|medium|large] [--repeat N] [--output results.json] [--compare old.json]
+#   python -m benchmarks.bench_suite compare old.json new.json
+
+import subprocess
+import argparse
+import platform
+import tempfile
+import shutil
+import json
+import time
+import sys
+import os
+
+import numpy as np
+
+from app.instrumentation import peak_memory
+
+sizes = {
+    'small':  { 'time_steps': 2000,  'mds': 200,  'stations': 1000 },
+    'medium': { 'time_steps': 20000, 'mds': 500,  'stations': 10000 },
+    'large':  { 'time_steps': 50000, 'mds': 1000, 'stations': 100000 },
+}
+well, connection = 'Well1', 'Connection1'
+client_image_query = 'cmap=turbo&max_width=4096&max_height=4096' # What the client asks for (see createImageUrl in the client)
+
+stage_cases = ['parse', 'load', 'gravity_correction', 'geometry', 'render', 'serialize', 'encode']
+endpoint_cases = {
+    # name -> (url, status)
+    'simulations':      ('/api/simulations', 200),
+    'geometry json':    (f'/api/simulations/{well}/{connection}', 200),
+    'geometry binary':  (f'/api/simulations/{well}/{connection}?format=binary', 200),
+    'pipepressure.png': (f'/api/simulations/{well}/{connection}/pipepressure.png', 200),
+    'pipestress.png (client)': (f'/api/simulations/{well}/{connection}/pipestress.png?{client_image_query}', 200),
+    'relative data':    (f'/api/simulations/{well}/{connection}/annuluspressure/data?relative=true', 200),
+    'tile':             (f'/api/simulations/{well}/{connection}/pipepressure/tiles/0/0/0.png', 200),
+    'pipepressure.png (not modified)': (f'/api/simulations/{well}/{connection}/pipepressure.png', 304),
+}
+
+
+def stage_case(name: str, data_dir: str, scratch_dir: str) -> tuple:
+    # Returns (run, size, unit), where run() does the work of the stage once, on size units of data
+    from app.SimulationLoader import SimulationLoader
+    from app.geometry_types import geometry_types
+    from app.path_segments import path_segments
+    from app.well_geometry import well_geometry_arrays, records, final_path_properties
+    from app.binary_geometry import pack_well_geometry
+    from app.relative_simulation_data import relative_simulation_data
+    from app.png_renderer import render_png
+    from starlette.responses import JSONResponse
+    import pandas as pd
+
+    sl = SimulationLoader(data_dir)
+    if name == 'parse':
+        repeats = iter(range(sys.maxsize))
+        run = lambda: SimulationLoader(data_dir, f'{scratch_dir}/{next(repeats)}').build_cache('pipepressure')
+        return run, os.path.getsize(sl.path('pipepressure.csv')) / 2**20, 'MB'
+    if name == 'load':
+        # Copied, so that the memory-mapped values are actually read
+        run = lambda: np.array(sl.simulation_arrays_or_csv('pipepressure')[2])
+        return run, sl.pipepressure().values.nbytes / 2**20, 'MB'
+
+    simulation_data = sl.pipepressure()
+    in_memory = pd.DataFrame(np.array(simulation_data.values), index=simulation_data.index, columns=simulation_data.columns)
+    well_path, pressure_per_meter = sl.well_path(), sl.fluiddef().iloc[0][0] * 9.81 * 1e-5
+    if name == 'gravity_correction':
+        run = lambda: relative_simulation_data(well_path, in_memory.transpose(), pressure_per_meter)
+        return run, in_memory.values.nbytes / 2**20, 'MB'
+    if name == 'render':
+        relative = relative_simulation_data(well_path, in_memory.transpose(), pressure_per_meter).values
+        return lambda: render_png(relative), relative.nbytes / 2**20, 'MB'
+
+    types = geometry_types(sl.geometrydef())
+    def geometry():
+        segments = path_segments(well_path, types, np.array(simulation_data.columns), 100.0)
+        return well_geometry_arrays(segments, types, simulation_data)
+    if name == 'geometry':
+        return geometry, len(well_path), 'stations'
+    arrays = geometry()
+    if name == 'serialize':
+        run = lambda: JSONResponse({ **arrays, 'pathSegments': records(arrays['pathSegments'], final_path_properties) }).body
+        return run, len(well_path), 'stations'
+    if name == 'encode':
+        return lambda: pack_well_geometry(arrays), len(well_path), 'stations'
+    raise ValueError(f"Unknown stage case '{name}'")
+
+
+def run_stage_case(name: str, data_dir: str, repeat: int) -> dict:
+    from app.instrumentation import recording_stages
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        run, size, unit = stage_case(name, data_dir, scratch_dir)
+        baseline = peak_memory()
+        seconds, stages = [], []
+        for _ in range(repeat):
+            with recording_stages() as recorded:
+                start = time.perf_counter()
+                run()
+                seconds.append(time.perf_counter() - start)
+            stages.append({ stage_name: totals[0] for stage_name, totals in recorded.totals.items() })
+        return summary(seconds, size, unit, baseline, stages)
+
+
+def run_endpoint_case(name: str, simulation_dir: str, repeat: int) -> dict:
+    # The first request is made with nothing in memory (but with the binary cache built, see prepare), and is reported
+    # as cold_ms (and cold_stages_ms). The rest are served from the in-memory cache of the API.
+    os.environ.update({ 'API_KEY': 'benchmark', 'COMPUTE_WORKERS': '0', 'SERVER_TIMING': '1', 'RESPONSE_CACHE': '0' })
+    os.environ.pop('ACCEL_REDIRECT_PREFIX', None)
+    os.environ.pop('PROFILE_DIR', None)
+    from starlette.testclient import TestClient
+    import app.main as api
+    api.simulation_dir = simulation_dir
+    client = TestClient(api.app)
+    url, status = endpoint_cases[name]
+    headers = { 'api_key': 'benchmark' }
+    if status == 304:
+        headers['If-None-Match'] = request(client, url, headers, 200).headers['ETag']
+    baseline = peak_memory()
+    seconds, stages, size = [], [], 0
+    for _ in range(1 + repeat):
+        start = time.perf_counter()
+        response = request(client, url, headers, status)
+        seconds.append(time.perf_counter() - start)
+        stages.append(server_timing(response.headers.get('Server-Timing', '')))
+        size = len(response.content)
+    result = summary(seconds[1:], 1, 'requests', baseline, stages[1:])
+    result.update({
+        'cold_ms': 1000 * seconds[0],
+        'cold_stages_ms': { stage_name: 1000 * duration for stage_name, duration in stages[0].items() },
+        'response_bytes': size,
+    })
+    return result
+
+
+def request(client, url: str, headers: dict, status: int):
+    response = client.get(url, headers=headers)
+    if response.status_code != status:
+        raise RuntimeError(f'GET {url} returned {response.status_code} instead of {status}: {response.text[:200]}')
+    return response
+
+
+def server_timing(header: str) -> dict:
+    # 'render;dur=12.3, encode;dur=4.5, total;dur=17.0' -> { 'render': 0.0123, 'encode': 0.0045 }
+    stages = {}
+    for entry in filter(None, (entry.strip() for entry in header.split(','))):
+        stage_name, _, duration = entry.partition(';dur=')
+        if stage_name != 'total':
+            stages[stage_name] = float(duration) / 1000
+    return stages
+
+
+def summary(seconds: list, size: float, unit: str, baseline_rss: int, stages: list) -> dict:
+    # stages is a list of { stage: seconds } (one per measured repeat), which are averaged
+    seconds = np.array(seconds)
+    stage_names = sorted(set(stage_name for repeat in stages for stage_name in repeat))
+    return {
+        'repeat': len(seconds),
+        'p50_ms': 1000 * float(np.percentile(seconds, 50)),
+        'p99_ms': 1000 * float(np.percentile(seconds, 99)),
+        'mean_ms': 1000 * float(seconds.mean()),
+        'min_ms': 1000 * float(seconds.min()),
+        'throughput': size / float(np.percentile(seconds, 50)),
+        'throughput_unit': f'{unit}/s',
+        'peak_rss_mb': peak_memory() / 2**20,
+        'peak_rss_increase_mb': (peak_memory() - baseline_rss) / 2**20,
+        'stages_ms': { stage_name: 1000 * float(np.mean([repeat.get(stage_name, 0.0) for repeat in stages])) for stage_name in stage_names },
+    }
+
+
+def prepare(simulation_dir: str):
+    # Build the binary cache of every simulation, and remove any stored responses (which would skip the computations)
+    from app.SimulationLoader import SimulationLoader, simulation_names
+    from app.precomputed import precomputed_dir
+    data_dir = f'{simulation_dir}/{well}/{connection}'
+    sl = SimulationLoader(data_dir)
+    for name in simulation_names:
+        if not sl.is_cache_fresh(name):
+            sl.build_cache(name)
+    shutil.rmtree(precomputed_dir(data_dir), ignore_errors=True)
+
+
+def run_case(kind: str, name: str, simulation_dir: str, repeat: int):
+    # Runs in the process started by measure, and prints the result as json on the last line
+    if kind == 'stage':
+        result = run_stage_case(name, f'{simulation_dir}/{well}/{connection}', repeat)
+    else:
+        result = run_endpoint_case(name, simulation_dir, repeat)
+    print(json.dumps(result))
+
+
+def measure(kind: str, name: str, simulation_dir: str, repeat: int) -> dict:
+    output = subprocess.check_output([sys.executable, '-m', 'benchmarks.bench_suite', 'case', kind, name, simulation_dir, str(repeat)])
+    return { 'kind': kind, 'name': name, **json.loads(output.decode().strip().splitlines()[-1]) }
+
+
+def git(*args: str) -> str:
+    try:
+        return subprocess.check_output(['git', *args], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    dataset = { **sizes[args.size], 'seed': args.seed }
+    for key in ['time_steps', 'mds', 'stations']:
+        if getattr(args, key) is not None:
+            dataset[key] = getattr(args, key)
+    data_root = args.data_dir or tempfile.mkdtemp()
+    simulation_dir = f'{data_root}/HeaveSim simulations'
+    try:
+        # Generated and prepared in separate processes as well, since child processes start out with the peak RSS of their parent
+        subprocess.check_call([
+            sys.executable, '-m', 'benchmarks.synthetic_simulation', simulation_dir,
+            '--time-steps', str(dataset['time_steps']), '--mds', str(dataset['mds']), '--stations', str(dataset['stations']), '--seed', str(dataset['seed']),
+        ])
+        subprocess.check_call([sys.executable, '-m', 'benchmarks.bench_suite', 'prepare', simulation_dir])
+        cases = [('stage', name) for name in stage_cases] + [('endpoint', name) for name in endpoint_cases]
+        cases = [(kind, name) for kind, name in cases if not args.cases or any(pattern in name for pattern in args.cases)]
+        print(format_header())
+        results = []
+        for kind, name in cases:
+            results.append(measure(kind, name, simulation_dir, args.repeat))
+            print(format_result(results[-1]), flush=True)
+        csv_bytes = os.path.getsize(f'{simulation_dir}/{well}/{connection}/pipepressure.csv')
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_root)
+
+    commit = git('rev-parse', 'HEAD')
+    report = {
+        'commit': commit,
+        'dirty': bool(git('status', '--porcelain', '--untracked-files=no')),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'size': args.size,
+        'dataset': { **dataset, 'csv_mb': csv_bytes / 2**20 },
+        'results': results,
+    }
+    output = args.output or f"bench_suite-{args.size}-{(commit or 'unknown')[:8]}.json"
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {output}')
+    if args.compare:
+        with open(args.compare) as f:
+            print()
+            print(format_comparison(json.load(f), report, args.threshold))
+
+
+def format_header() -> str:
+    return f'{"kind":<9} {"case":<32} {"p50 ms":>9} {"p99 ms":>9} {"cold ms":>9} {"throughput":>18} {"peak MB":>8} {"+MB":>7}'
+
+
+def format_result(result: dict) -> str:
+    cold = f"{result['cold_ms']:.1f}" if 'cold_ms' in result else '-'
+    throughput = f"{result['throughput']:.1f} {result['throughput_unit']}"
+    return (
+        f"{result['kind']:<9} {result['name']:<32} {result['p50_ms']:>9.1f} {result['p99_ms']:>9.1f} {cold:>9} "
+        f"{throughput:>18} {result['peak_rss_mb']:>8.0f} {result['peak_rss_increase_mb']:>7.0f}"
+    )
+
+
+def format_comparison(old: dict, new: dict, threshold: float) -> str:
+    # p50 latency and peak memory of the cases in both reports. Changes larger than threshold (relative) are marked.
+    lines = [
+        f"{(old['commit'] or 'unknown')[:8]} -> {(new['commit'] or 'unknown')[:8]}" + (' (with uncommitted changes)' if new['dirty'] else ''),
+        f'{"kind":<9} {"case":<32} {"old p50 ms":>11} {"new p50 ms":>11} {"change":>8} {"old MB":>7} {"new MB":>7} {"change":>8}',
+    ]
+    if old['dataset'] != new['dataset']:
+        lines.insert(1, f"Warning: different datasets ({old['dataset']} vs {new['dataset']})")
+    old_results = { (result['kind'], result['name']): result for result in old['results'] }
+    for result in new['results']:
+        previous = old_results.get((result['kind'], result['name']))
+        if previous is None:
+            continue
+        changes = [
+            relative_change(previous['p50_ms'], result['p50_ms'], threshold),
+            relative_change(previous['peak_rss_mb'], result['peak_rss_mb'], threshold),
+        ]
+        lines.append(
+            f"{result['kind']:<9} {result['name']:<32} {previous['p50_ms']:>11.1f} {result['p50_ms']:>11.1f} {changes[0]:>8} "
+            f"{previous['peak_rss_mb']:>7.0f} {result['peak_rss_mb']:>7.0f} {changes[1]:>8}"
+        )
+    return '\n'.join(lines)
+
+
+def relative_change(old: float, new: float, threshold: float) -> str:
+    # Like '+25%!' (a change beyond the threshold) or '-3%'
+    change = new / old - 1 if old > 0 else 0.0
+    return f"{100 * change:+.0f}%{'!' if abs(change) > threshold else ''}"
+
+
+def compare(args):
+    reports = []
+    for file_name in [args.old, args.new]:
+        with open(file_name) as f:
+            reports.append(json.load(f))
+    print(format_comparison(*reports, args.threshold))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages and API routes on synthetic simulations.')
+    commands = parser.add_subparsers(dest='command')
+    run_parser = commands.add_parser('run', help='Run the benchmarks and store the results as json')
+    run_parser.add_argument('--size', choices=sorted(sizes), default='small')
+    run_parser.add_argument('--time-steps', type=int, help='Override the number of time steps of the size')
+    run_parser.add_argument('--mds', type=int, help='Override the number of measure depths of the size')
+    run_parser.add_argument('--stations', type=int, help='Override the number of survey stations of the size')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--repeat', type=int, default=20, help='Number of measured repeats of every case')
+    run_parser.add_argument('--cases', nargs='*', help='Only run the cases with one of these in their name')
+    run_parser.add_argument('--data-dir', help='Keep the generated data here (and reuse it the next time), instead of in a temporary directory')
+    run_parser.add_argument('--output', help='Where to store the results (default: bench_suite-<size>-<commit>.json)')
+    run_parser.add_argument('--compare', help='Results of an earlier run to compare with')
+    run_parser.add_argument('--threshold', type=float, default=0.1, help='Mark relative changes larger than this when comparing')
+    compare_parser = commands.add_parser('compare', help='Compare the results of two runs')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.1)
+    # Used internally, for running things in a separate process
+    case_parser = commands.add_parser('case')
+    case_parser.add_argument('kind', choices=['stage', 'endpoint'])
+    case_parser.add_argument('name')
+    case_parser.add_argument('simulation_dir')
+    case_parser.add_argument('repeat', type=int)
+    prepare_parser = commands.add_parser('prepare')
+    prepare_parser.add_argument('simulation_dir')
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    elif args.command == 'compare':
+        compare(args)
+    elif args.command == 'case':
+        run_case(args.kind, args.name, args.simulation_dir, args.repeat)
+    elif args.command == 'prepare':
+        prepare(args.simulation_dir)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
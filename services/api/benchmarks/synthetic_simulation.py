@@ -0,0 +1,122 @@
+# Author: Tobias Bergkvist
+# Purpose: Generate synthetic HeaveSIM simulations in the same format as the real ones, at any size, for benchmarks.
+# A connection directory gets pipepressure.csv, annuluspressure.csv and pipestress.csv (time steps as rows,
+# measure depths as float column headers), well_path.csv (separated by ;), geometrydef.txt and fluiddef.txt.
+# The values are a hydrostatic pressure profile with a heave motion on top, and are the same for the same seed.
+# Run from services/api with: python -m benchmarks.synthetic_simulation <simulation dir> [--time-steps N] [--mds N] ...
+
+import numpy as np
+import pandas as pd
+import argparse
+import json
+import os
+
+from app.SimulationLoader import simulation_names
+
+# Inner diameters (inches) and lengths/depths (meters) of the sections, in the order of geometrydef.txt (see geometry_types.py)
+geometrydef_values = [
+    (8.5, 'Open hole diameter (in)'),
+    (19, 'Riser inner diameter (in)'),
+    (400, 'Riser length (m)'),
+    (12.3, 'Casing inner diameter (in)'),
+    (2500, 'Casing shoe depth (m)'),
+    (8.7, 'Liner inner diameter (in)'),
+    (1500, 'Liner length (m)'),
+    (4000, 'Liner shoe depth (m)'),
+    (1000, 'Open hole length (m)'),
+    (900, 'Rathole length (m)'),
+]
+fluid_density = 1500 # kg/m^3
+well_depth = 5900 # Measure depth of the end of the open hole
+time_step = 0.05 # seconds
+heave_period = 12.0 # seconds
+
+
+def synthetic_well_path(stations: int, md_stop: float = 6000) -> pd.DataFrame:
+    # Vertical down to 1000 m, then building up to 85 degrees, while slowly turning
+    md = np.linspace(0, md_stop, stations)
+    inc = np.clip((md - 1000) / 40, 0, 85)
+    azi = 30 + 10 * np.sin(md / 500)
+    return pd.DataFrame({ 'md': md, 'inc': inc, 'azi': azi, 'tvd': np.cumsum(np.gradient(md) * np.cos(np.radians(inc))) })
+
+
+def synthetic_geometry_types() -> list:
+    # The same sections as geometrydef_values, as returned by geometry_types
+    return [
+        { 'name': 'riser',         'radius': 0.24, 'md_start': 0,    'md_stop': 400 },
+        { 'name': 'cased section', 'radius': 0.16, 'md_start': 400,  'md_stop': 2500 },
+        { 'name': 'liner',         'radius': 0.11, 'md_start': 2500, 'md_stop': 4000 },
+        { 'name': 'open hole',     'radius': 0.11, 'md_start': 4000, 'md_stop': 5900 },
+    ]
+
+
+def write_simulation(data_dir: str, time_steps: int, mds: int, stations: int = 1000, simulations: list = simulation_names, seed: int = 0):
+    # Writes one connection directory. The csv files are written a block of time steps at a time,
+    # so that the memory use stays low no matter how large they are.
+    os.makedirs(data_dir, exist_ok=True)
+    well_path = synthetic_well_path(stations)
+    well_path.rename(columns={ 'md': 'Md', 'inc': 'Inc', 'azi': 'Azi', 'tvd': 'Tvd' }).to_csv(f'{data_dir}/well_path.csv', sep=';', index=False)
+    with open(f'{data_dir}/geometrydef.txt', 'w') as f:
+        f.writelines(f'{value} # {description}\n' for value, description in geometrydef_values)
+    with open(f'{data_dir}/fluiddef.txt', 'w') as f:
+        f.write(f'{fluid_density} # Density (kg/m^3)\n0.02 # Viscosity (Pa s)\n')
+
+    md = np.linspace(0, well_depth, mds)
+    tvd = np.interp(md, well_path.md, well_path.tvd)
+    hydrostatic = 1.01325 + fluid_density * 9.81 * 1e-5 * tvd # bar
+    for index, name in enumerate(simulations):
+        rng = np.random.default_rng([seed, index])
+        with open(f'{data_dir}/{name}.csv', 'w') as f:
+            f.write(','.join(['time'] + [repr(float(value)) for value in md]) + '\n')
+            for start in range(0, time_steps, 1000):
+                time = time_step * np.arange(start, min(time_steps, start + 1000))
+                heave = np.sin(2 * np.pi * time / heave_period)[:, np.newaxis] * (1 + md / well_depth)
+                if name == 'pipestress':
+                    values = -0.75 * tvd + 20 * heave
+                else:
+                    values = hydrostatic + (5 if name == 'pipepressure' else 2) * heave
+                values = values + 0.1 * rng.standard_normal((len(time), mds))
+                np.savetxt(f, np.column_stack([time, values]), fmt='%.6g', delimiter=',')
+
+
+def write_simulations(simulation_dir: str, wells: int = 1, connections: int = 1, **sizes):
+    # Writes wells x connections connection directories (Well1/Connection1 etc.), see write_simulation for the sizes.
+    # Returns the description of the dataset, which is also stored as dataset.json (see is_generated).
+    for well in range(1, wells + 1):
+        for connection in range(1, connections + 1):
+            write_simulation(f'{simulation_dir}/Well{well}/Connection{connection}', **sizes)
+    dataset = { 'wells': wells, 'connections': connections, **sizes }
+    with open(f'{os.path.dirname(simulation_dir)}/dataset.json', 'w') as f:
+        json.dump(dataset, f)
+    return dataset
+
+
+def is_generated(simulation_dir: str, dataset: dict) -> bool:
+    # Whether simulation_dir already contains the given dataset (generating a large one takes a while)
+    try:
+        with open(f'{os.path.dirname(simulation_dir)}/dataset.json') as f:
+            return json.load(f) == dataset
+    except (OSError, ValueError):
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic HeaveSIM simulations.')
+    parser.add_argument('simulation_dir', help='Directory for the wells (like "data/HeaveSim simulations")')
+    parser.add_argument('--time-steps', type=int, default=2000)
+    parser.add_argument('--mds', type=int, default=200, help='Number of measure depths (columns) in the simulation csv files')
+    parser.add_argument('--stations', type=int, default=1000, help='Number of survey stations in well_path.csv')
+    parser.add_argument('--wells', type=int, default=1)
+    parser.add_argument('--connections', type=int, default=1, help='Number of connections per well')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    sizes = { 'time_steps': args.time_steps, 'mds': args.mds, 'stations': args.stations, 'seed': args.seed }
+    dataset = { 'wells': args.wells, 'connections': args.connections, **sizes }
+    if is_generated(args.simulation_dir, dataset):
+        print(f'{args.simulation_dir} already contains this dataset')
+        return
+    write_simulations(args.simulation_dir, args.wells, args.connections, **sizes)
+
+
+if __name__ == '__main__':
+    main()
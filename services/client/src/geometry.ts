@@ -4,7 +4,7 @@
  */
 
 import { BufferGeometryUtils } from 'three/examples/jsm/utils/BufferGeometryUtils'
-import { PathSegment, Position, Rotation, CasingShoe } from './loaders'
+import { PathSegmentArrays, Position, Rotation, CasingShoe } from './loaders'
 import * as THREE from 'three'
 
 function getMatrixWorld (posRot: Position & Rotation, { updateParents = true, updateChildren = false } = {}) {
@@ -15,19 +15,24 @@ function getMatrixWorld (posRot: Position & Rotation, { updateParents = true, up
   return mesh.matrixWorld
 }
 
-export function createWellPathBufferGeometry(pathSegments: Array<PathSegment>): THREE.BufferGeometry {
-  return BufferGeometryUtils.mergeBufferGeometries(
-    pathSegments.map(pathSegment => {
-      const bufferGeometry = new THREE.CylinderBufferGeometry(pathSegment.radius, pathSegment.radius, pathSegment.length, 20)
-      const matrixWorld = getMatrixWorld(pathSegment)
-      bufferGeometry.applyMatrix(matrixWorld)
+export function createWellPathBufferGeometry(pathSegments: PathSegmentArrays, count: number): THREE.BufferGeometry {
+  // The properties are read directly from the arrays of the binary geometry, one index per path segment
+  const { posx, posy, posz, rotx, roty, rotz, radius, length, imageRow } = pathSegments
+  const transform = new THREE.Object3D()
+  const bufferGeometries = []
+  for (let i = 0; i < count; i++) {
+    const bufferGeometry = new THREE.CylinderBufferGeometry(radius[i], radius[i], length[i], 20)
+    transform.position.set(posx[i], posy[i], posz[i])
+    transform.rotation.set(rotx[i], roty[i], rotz[i])
+    transform.updateMatrix()
+    bufferGeometry.applyMatrix(transform.matrix)
 
-      const bufferAttribs = new Float32Array(bufferGeometry.getAttribute('position').count)
-      for (let i = 0; i < bufferAttribs.length; i++) bufferAttribs[i] = pathSegment.imageRow
-      bufferGeometry.setAttribute('imageRow', new THREE.Float32BufferAttribute(bufferAttribs, 1))
-      return bufferGeometry
-    })
-  )
+    const bufferAttribs = new Float32Array(bufferGeometry.getAttribute('position').count)
+    bufferAttribs.fill(imageRow[i])
+    bufferGeometry.setAttribute('imageRow', new THREE.Float32BufferAttribute(bufferAttribs, 1))
+    bufferGeometries.push(bufferGeometry)
+  }
+  return BufferGeometryUtils.mergeBufferGeometries(bufferGeometries)
 }
 
 export function createCasingShoeBufferGeometry(casingShoes: Array<CasingShoe>): THREE.BufferGeometry {
@@ -57,7 +57,7 @@ ensureAuthentication()
   configEmitter.geometry.subscribe(async geometryConfig => {
     // Could be dangerous to have this await. Changing options quickly will cause a race condition
     const geometryData = await loadWellGeometry(geometryConfig.well, geometryConfig.connection, geometryConfig.radiusScaling)
-    wellPathMesh.geometry = createWellPathBufferGeometry(geometryData.pathSegments)
+    wellPathMesh.geometry = createWellPathBufferGeometry(geometryData.pathSegments, geometryData.count)
     casingShoeMesh.geometry = createCasingShoeBufferGeometry(geometryData.casingShoes)
     canvas3D.setCamera({ ...geometryData.centre, distance: 3000 })
     timeline.setTimeDimensions(geometryData.time)
@@ -10,7 +10,6 @@ export type Rotation = { rotx: number, roty: number, rotz: number }
 export type TimeSequence = { min: number, max: number, step: number }
 export type CasingShoe = Position & Rotation & { label: string, radius: number }
 export type PathSegment = Position & Rotation & { radius: number, length: number, imageRow: number }
-export type GeometryData = { pathSegments: Array<PathSegment>, casingShoes: Array<CasingShoe>, time: TimeSequence, centre: Position }
 export type WellsAndConnections = { [well: string]: Array<string> }
 
 export async function ensureAuthentication(): Promise<WellsAndConnections> {
@@ -26,13 +25,34 @@ export async function ensureAuthentication(): Promise<WellsAndConnections> {
   }
 }
 
-export async function loadWellGeometry (well: string, connection: string, radiusScaling: number): Promise<GeometryData> {
-  const response = await Axios.get(`/api/simulations/${well}/${connection}?radius_scaling=${radiusScaling}`)
-  return response.data as GeometryData
+export type PathSegmentArrays = { [property in keyof PathSegment]: Float32Array }
+export type BinaryGeometryData = { pathSegments: PathSegmentArrays, count: number, casingShoes: Array<CasingShoe>, time: TimeSequence, centre: Position }
+
+export async function loadWellGeometry (well: string, connection: string, radiusScaling: number): Promise<BinaryGeometryData> {
+  // The binary layout is a lot smaller than JSON, and the arrays don't need to be parsed (or turned into objects)
+  const response = await Axios.get(`/api/simulations/${well}/${connection}?radius_scaling=${radiusScaling}`, {
+    headers: { Accept: 'application/octet-stream' },
+    responseType: 'arraybuffer'
+  })
+  return parseBinaryGeometry(response.data)
+}
+
+export function parseBinaryGeometry (buffer: ArrayBuffer): BinaryGeometryData {
+  // See services/api/app/binary_geometry.py for the layout
+  const headerLength = new DataView(buffer).getUint32(0, true)
+  const { properties, ...header } = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, headerLength)))
+  const pathSegments = {}
+  let offset = 4 + headerLength
+  for (const property of properties) {
+    pathSegments[property] = new Float32Array(buffer, offset, header.count)
+    offset += 4 * header.count
+  }
+  return { ...header, pathSegments: pathSegments as PathSegmentArrays }
 }
 
-export function createImageUrl ({ well, connection, simulation, colormap, customThresholds, vmin, vmax }) {
-  const imageUrl = `/api/simulations/${well}/${connection}/${simulation}.png?cmap=${colormap}` + (
+export function createImageUrl ({ well, connection, simulation, colormap, customThresholds, vmin, vmax, maxSize = 4096 }) {
+  // Let the API downsample large images (keeping pressure spikes), instead of downloading everything and scaling it here
+  const imageUrl = `/api/simulations/${well}/${connection}/${simulation}.png?cmap=${colormap}&max_width=${maxSize}&max_height=${maxSize}` + (
     customThresholds 
       ? `&vmin=${vmin}&vmax=${vmax}` 
       : ''